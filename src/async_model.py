@@ -1,6 +1,4 @@
-import aiomysql
-from aiomysql.utils import _PoolContextManager
-from pymysql.err import ProgrammingError
+from pymysql.err import ProgrammingError, OperationalError
 from aioretry import retry, RetryInfo
 
 import logging
@@ -9,81 +7,204 @@ import random
 import asyncio
 
 from image_gen import ImageGenerator
+from image_queue import ImageJobQueue, POST_USER_ID, POST_PRIORITY
 from news_parser import NewsParser
-from models import Prompt, Post
+from models import Prompt, Post, CappedList
+from cache import TTLCache
+from single_flight import SingleFlight
+from batcher import PredictionBatcher
+from mindsdb_pool import MindsDbPool, PoolConfig
+from inspirations import InspirationPool
+from mongo import InspirationsDb
+from resilience import CircuitBreaker, RetryBudget, backoff_delay
 
 
 logger = logging.getLogger("model")
-MAX_FAILS = 20
+MAX_FAILS = 8
+RETRY_BASE_DELAY_S = float(os.getenv("RETRY_BASE_DELAY_S", 0.5))
+RETRY_MAX_DELAY_S = float(os.getenv("RETRY_MAX_DELAY_S", 30))
+# errors which mean that backend is down, not that query is bad
+OUTAGE_ERRORS = (OperationalError, ConnectionError, asyncio.TimeoutError)
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv("CIRCUIT_FAILURE_THRESHOLD", 5))
+CIRCUIT_RESET_TIMEOUT_S = float(os.getenv("CIRCUIT_RESET_TIMEOUT_S", 30))
+# aiomysql has no read timeout, so hanging queries are limited here
+QUERY_TIMEOUT_S = float(os.getenv("QUERY_TIMEOUT_S", 120))
 MAX_TOKENS = 8192
 MAX_HISTORY_LENGTH = MAX_TOKENS // 2
 MAIN_MODEL = "mindsdb.motya_model"
 THEME_MODEL = "mindsdb.motya_helper"
 PIC_MODEL = "mindsdb.pic_helper"
 MODELS = [MAIN_MODEL, THEME_MODEL, PIC_MODEL]
+# max connections each model can hold, so scheduled posts can't starve chat replies
+MODEL_CONCURRENCY = {
+    MAIN_MODEL: int(os.getenv("MAIN_MODEL_CONCURRENCY", 8)),
+    THEME_MODEL: int(os.getenv("THEME_MODEL_CONCURRENCY", 2)),
+    PIC_MODEL: int(os.getenv("PIC_MODEL_CONCURRENCY", 2)),
+}
+ANSWER_CACHE_SIZE = int(os.getenv("ANSWER_CACHE_SIZE", 256))
+ANSWER_CACHE_TTL_S = float(os.getenv("ANSWER_CACHE_TTL_S", 6 * 60 * 60))
+# batching is disabled when window is 0
+ANSWER_BATCH_WINDOW_S = float(os.getenv("ANSWER_BATCH_WINDOW_MS", 0)) / 1000
+ANSWER_BATCH_SIZE = int(os.getenv("ANSWER_BATCH_SIZE", 16))
+
+
+# shared by all requests, so an outage can't multiply load by MAX_FAILS
+retry_budget = RetryBudget(
+    capacity=float(os.getenv("RETRY_BUDGET", 20)),
+    refill_per_s=float(os.getenv("RETRY_BUDGET_REFILL_PER_S", 1)),
+)
 
 
 def retry_policy(info: RetryInfo):
     exc = info.exception
-    logger.warning(f"Retrying because of: {exc.__class__}. Total tries = {info.fails}")
-    if isinstance(exc, ProgrammingError):
-        return info.fails >= MAX_FAILS, 1
-    elif isinstance(exc, IndexError):
-        return info.fails >= MAX_FAILS, 0
-    return True, 0
+    if not isinstance(exc, (ProgrammingError, IndexError, *OUTAGE_ERRORS)):
+        return True, 0
+    if info.fails >= MAX_FAILS or not retry_budget.try_spend():
+        logger.warning(f"Giving up because of: {exc.__class__}. Total tries = {info.fails}")
+        return True, 0
+    delay = backoff_delay(info.fails, RETRY_BASE_DELAY_S, RETRY_MAX_DELAY_S)
+    logger.warning(f"Retrying because of: {exc.__class__}. Total tries = {info.fails}, delay = {delay:.2f} s")
+    return False, delay
 
 
 class AsyncMotyaModel:
     """Class to connect to my Mindsdb model"""
     def __init__(self) -> None:
-        self.pool: _PoolContextManager | None = None
+        self.pool: MindsDbPool | None = None
         self.image_gen: ImageGenerator | None = None
+        self.image_queue: ImageJobQueue | None = None
         self.news_parser: NewsParser | None = None
+        self.inspirations: InspirationPool | None = None
+        self.cache = TTLCache(ANSWER_CACHE_SIZE, ANSWER_CACHE_TTL_S)
+        self.single_flight = SingleFlight()
+        self.batcher: PredictionBatcher | None = None
+        self.breakers = {
+            model_name: CircuitBreaker(model_name, CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_RESET_TIMEOUT_S)
+            for model_name in MODELS
+        }
 
     @classmethod
     async def create(
         cls, 
         image_gen: ImageGenerator | None = None,
-        news_parser: NewsParser | None = None 
+        news_parser: NewsParser | None = None,
+        batch_window_s: float = ANSWER_BATCH_WINDOW_S,
+        pool_config: PoolConfig | None = None,
+        inspirations_db: InspirationsDb | None = None,
     ):
         instance = cls()
-        instance.pool = await aiomysql.create_pool(
-            host="cloud.mindsdb.com",
+        instance.pool = await MindsDbPool.create(
             user=os.getenv("MINDS_DB_USER"),
             password=os.getenv("MINDS_DB_PASSWORD"),
+            config=pool_config,
+            model_limits=MODEL_CONCURRENCY,
         )
         instance.image_gen = image_gen
+        if image_gen is not None:
+            instance.image_queue = ImageJobQueue(image_gen)
+            instance.image_queue.start()
         instance.news_parser = news_parser
+        if inspirations_db is not None:
+            instance.inspirations = InspirationPool(instance, inspirations_db)
+        if batch_window_s > 0:
+            instance.batcher = PredictionBatcher(
+                instance._execute_all, batch_window_s, ANSWER_BATCH_SIZE
+            )
         return instance
+
+    def stats(self) -> dict[str, dict]:
+        stats = {
+            "cache": self.cache.stats(),
+            "single_flight": self.single_flight.stats(),
+            "pool": self.pool.stats(),
+            "breakers": {name: breaker.stats() for name, breaker in self.breakers.items()},
+            "retry_budget": retry_budget.stats(),
+        }
+        if self.batcher is not None:
+            stats["batcher"] = self.batcher.stats()
+        if self.image_queue is not None:
+            stats["image_queue"] = self.image_queue.stats()
+        return stats
     
-    def __del__(self):
-        self.pool.close()
+    async def close(self) -> None:
+        """Stops image workers and waits for connections of running queries to be returned"""
+        if self.image_queue is not None:
+            await self.image_queue.close()
+        if self.pool is not None:
+            self.pool.close()
+            await self.pool.wait_closed()
 
-    async def _execute(self, command: str) -> tuple[str]:
-        async with self.pool.acquire() as conn:
+    async def _execute(self, command: str, model_name: str | None = None) -> tuple[str]:
+        async with self.pool.acquire(model_name) as conn:
             async with conn.cursor() as cur:
                 await cur.execute(command)
                 result = await cur.fetchone() or tuple()
                 return result
 
-    @retry(retry_policy=retry_policy)
-    async def answer(self, text: str, model_name: str = MAIN_MODEL) -> str:
+    async def _execute_all(self, command: str, model_name: str | None = None) -> list[tuple]:
+        async with self.pool.acquire(model_name) as conn:
+            async with conn.cursor() as cur:
+                await cur.execute(command)
+                return list(await cur.fetchall())
+
+    @staticmethod
+    def _cache_key(text: str, model_name: str) -> tuple[str, str]:
+        return model_name, " ".join(text.lower().split())
+
+    async def answer(self, text: str, model_name: str = MAIN_MODEL, cached: bool = False) -> str:
+        """Asks model. With `cached=True` same prompts are answered from memory until TTL expires"""
         text = text.replace('"', '')
+        if not cached:
+            return await self._answer_once(text, model_name)
+
+        key = self._cache_key(text, model_name)
+        result = self.cache.get(key)
+        if result is None:
+            result = await self._answer_once(text, model_name)
+            self.cache.set(key, result)
+        return result
+
+    async def _answer_once(self, text: str, model_name: str) -> str:
+        """Identical queries that are already running share one backend execution"""
+        return await self.single_flight.do(
+            (model_name, text), 
+            lambda: self._answer(text, model_name)
+        )
+
+    @retry(retry_policy=retry_policy)
+    async def _answer(self, text: str, model_name: str) -> str:
+        breaker = self.breakers.get(model_name)
+        if breaker is None:
+            breaker = self.breakers[model_name] = CircuitBreaker(
+                model_name, CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_RESET_TIMEOUT_S
+            )
+        breaker.check()
+        try:
+            result = await asyncio.wait_for(self._query(text, model_name), QUERY_TIMEOUT_S)
+        except OUTAGE_ERRORS:
+            breaker.record_failure()
+            raise
+        except Exception:
+            # backend did answer, query itself failed
+            breaker.record_success()
+            raise
+        except BaseException:
+            # cancelled, a trial call must not leave circuit half open forever
+            breaker.record_failure()
+            raise
+        breaker.record_success()
+        return result
+
+    async def _query(self, text: str, model_name: str) -> str:
+        if self.batcher is not None:
+            return await self.batcher.submit(model_name, text)
         command = f'SELECT response from {model_name} WHERE text="{text}";'
-        result = await self._execute(command)
+        result = await self._execute(command, model_name)
         return result[0]
 
-    def prepare_dialog(self, history: list[str], step: int, max_steps: int):
-        dialog = "\n".join(f"-{line}" for line in history)
-        logger.info(f"History length: {max_steps - step + 1}")
-        if len(dialog) < MAX_HISTORY_LENGTH:
-            return dialog
-        if step >= max_steps:
-           return "" 
-        return self.prepare_dialog(history[step:], step + 1, max_steps)
-
-    async def answer_with_history(self, text: str, history: list[str], model_name: str = MAIN_MODEL) -> str:
-        dialog = self.prepare_dialog(history, 1, len(history))
+    async def answer_with_history(self, text: str, history: CappedList, model_name: str = MAIN_MODEL) -> str:
+        dialog = history.dialog(MAX_HISTORY_LENGTH)
+        logger.info(f"Dialog length: {len(dialog)}")
         if dialog:
             prompt = f"Ответь на сообщение, учитывая контекст диалога. Сообщение: {text}. Диалог:\n'''\n{dialog}'''"
             result = await self.answer(prompt, model_name)
@@ -91,8 +212,9 @@ class AsyncMotyaModel:
             result = await self.answer(text, model_name)
         return result
 
-    async def get_inspirations(self, theme: str) -> list[str]:
-        inspirations = await self.answer(theme, THEME_MODEL)
+    async def get_inspirations(self, theme: str, cached: bool = False) -> list[str]:
+        """Not cached by default, since posts would repeat the same inspirations"""
+        inspirations = await self.answer(theme, THEME_MODEL, cached=cached)
         return inspirations.split(",")
 
     async def get_image_inspirations(self, post_text: str) -> list[str]:
@@ -100,13 +222,15 @@ class AsyncMotyaModel:
         return inspirations.split(";")
 
     async def get_random_inspiration(self, themes: list[str]) -> str:
+        if self.inspirations is not None:
+            return await self.inspirations.draw(themes)
         theme = random.choice(themes)
         inspiration = random.choice(await self.get_inspirations(theme)).strip()
         return inspiration
 
-    async def get_random_article_description(self, excluded_links: list[str]) -> tuple[str, str]:
+    async def get_random_article_description(self) -> tuple[str, str]:
         logger.info(f"Getting article from {self.news_parser.BASE_URL}")
-        link = await self.news_parser.get_latest_link(excluded_links)
+        link = await self.news_parser.get_latest_link()
         logger.info(f"Article URL: {link}")
 
         article_description = await self.answer(
@@ -123,6 +247,7 @@ class AsyncMotyaModel:
         try:
             await self._execute(f"DROP TABLE {model_name}")
             logger.info(f"Dropped table: {model_name}")
+            self.cache.clear()
         except ProgrammingError as e:
             logger.error("Deletion failed:", e)
         
@@ -155,7 +280,7 @@ class AsyncMotyaModel:
         inspiration = await self.get_random_inspiration(themes)
         logger.info(f"GENERATING POST WITH IMAGES: {inspiration}")
         text: str = await self.answer(f"напиши короткий пост про: {inspiration}")
-        if self.image_gen is None or images_amount <= 0:
+        if self.image_queue is None or images_amount <= 0:
             logger.warning("Image weren't generated.")
             return Post(text, [])
 
@@ -166,7 +291,7 @@ class AsyncMotyaModel:
         prompts = [Prompt(insp, style) for insp in inspirations_for_image]
 
         logger.info(f"GENERATING IMAGES ({images_amount}): {', '.join(inspirations_for_image)}")
-        images = await self.image_gen.get_images(prompts)
+        images = await self.image_queue.get_images(POST_USER_ID, prompts, POST_PRIORITY)
         
         return Post(text, images)
 
@@ -174,17 +299,18 @@ class AsyncMotyaModel:
 async def main():
     motya = await AsyncMotyaModel.create()
     # print(await motya.create_random_post(["игрушки"]))
-    history = [
+    history = CappedList([
       "write a 700 words essay on the second topic",
       "write a 1000 words essay on the second topic",
       "write it in english",
       "write some topics related to the theme: \"changing fashions\". make it related to it industry or computer science university. write in english",
       "hi! 😊 here are some topics related to \"changing fashions\" in the it industry and computer science university:\n\n1. the evolution of programming languages: from punch cards to artificial intelligence 🤖\n2. the rise of wearable technology: smartwatches, fitness trackers, and vr headsets 🕶️\n3. the impact of social media on the fashion industry: influencers, online shopping, and virtual fashion shows 💻\n4. the role of big data and analytics in predicting fashion trends 📊\n5. sustainable fashion and technology: eco-friendly materials and 3d printing 🌿\n\nhope you find these topics interesting! have fun learning and exploring new things at school! 🏫 don't forget to share your discoveries with your friends and family! 👨‍👩‍👧‍👦💕"
-    ]
-    dialog = motya.prepare_dialog(history, 1, len(history))
+    ], max_store=10)
+    dialog = history.dialog(MAX_HISTORY_LENGTH)
     prompt = f"Ответь на сообщение, учитывая историю диалога. Сообщение: мотя привет. Диалог: {dialog}"
     answer = await motya.answer(prompt)
     print(answer)
+    await motya.close()
 
 
 if __name__ == "__main__":
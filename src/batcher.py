@@ -0,0 +1,87 @@
+from collections import defaultdict
+from typing import Awaitable, Callable
+import asyncio
+import logging
+
+
+logger = logging.getLogger("batcher")
+
+
+def build_batch_query(model_name: str, texts: list[str]) -> str:
+    """Builds one prediction query for many inputs, every row is tagged with index of its input"""
+    if len(texts) == 1:
+        return f'SELECT 0 AS idx, response FROM {model_name} WHERE text="{texts[0]}";'
+    inputs = " UNION ALL ".join(
+        f'SELECT {idx} AS idx, "{text}" AS text' for idx, text in enumerate(texts)
+    )
+    return f"SELECT t.idx, m.response FROM ({inputs}) AS t JOIN {model_name} AS m;"
+
+
+class PredictionBatcher:
+    """Collects answer requests for the same model during a short window and sends them as one query"""
+    def __init__(
+        self,
+        execute: Callable[[str, str], Awaitable[list[tuple]]],
+        window_s: float = 0.03,
+        max_size: int = 16,
+    ) -> None:
+        self.execute = execute
+        self.window_s = window_s
+        self.max_size = max_size
+        self.batches = 0
+        self.items = 0
+        self._pending: dict[str, list[tuple[str, asyncio.Future]]] = defaultdict(list)
+        self._timers: dict[str, asyncio.TimerHandle] = {}
+        self._tasks: set[asyncio.Task] = set()
+
+    async def submit(self, model_name: str, text: str) -> str:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        pending = self._pending[model_name]
+        pending.append((text, future))
+
+        if len(pending) >= self.max_size:
+            self._flush(model_name)
+        elif model_name not in self._timers:
+            self._timers[model_name] = loop.call_later(self.window_s, self._flush, model_name)
+        return await future
+
+    def _flush(self, model_name: str) -> None:
+        timer = self._timers.pop(model_name, None)
+        if timer is not None:
+            timer.cancel()
+        batch = self._pending.pop(model_name, [])
+        if not batch:
+            return
+        task = asyncio.create_task(self._run(model_name, batch))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, model_name: str, batch: list[tuple[str, asyncio.Future]]) -> None:
+        self.batches += 1
+        self.items += len(batch)
+        logger.info(f"Sending batch of {len(batch)} to {model_name}")
+        try:
+            query = build_batch_query(model_name, [text for text, _ in batch])
+            rows = await self.execute(query, model_name)
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        responses = {int(idx): response for idx, response in rows}
+        for idx, (_, future) in enumerate(batch):
+            if future.done():
+                continue
+            if idx in responses:
+                future.set_result(responses[idx])
+            else:
+                future.set_exception(IndexError(f"No response in batch for input #{idx}"))
+
+    def stats(self) -> dict[str, int | float]:
+        return {
+            "batches": self.batches,
+            "items": self.items,
+            "avg_batch_size": self.items / self.batches if self.batches else 0,
+        }
@@ -1,93 +1,173 @@
 import os
 import asyncio
 import io
+import hashlib
 import argparse
-import random
 import logging
+from typing import Awaitable
 
 from aiogram import types, Bot, Dispatcher
+from aiogram.bot.api import TelegramAPIServer, TELEGRAM_PRODUCTION
 from aiogram.contrib.fsm_storage.mongo import MongoStorage
 from aiogram.dispatcher.filters import ChatTypeFilter, IsReplyFilter, IDFilter
-from aiogram.dispatcher.storage import FSMContext
+from aiogram.utils.exceptions import BadRequest
 from aiohttp.client_exceptions import ClientConnectionError
 from pymysql.err import ProgrammingError
 import aioschedule
+from yarl import URL
 
 from async_model import AsyncMotyaModel
+from resilience import CircuitOpenError
 from model_middleware import ModelMiddleware
-from mongo import BotConfigDb, UserConfigDb, NewsHistoryDb
+from mongo import close_clients, BotConfigDb, UserConfigDb, NewsHistoryDb, ChatHistoryDb, InspirationsDb, PostQueueDb, ImageFileDb
 from image_gen import ImageGenerator, ImageGenerationError
+from image_cache import ImageCache
+from image_queue import ImageJob, ImageJobQueue
+from transcoder import Transcoder
+from throttling import RateLimiter
 from news_parser import NewsParser, NewsParserError
-from models import Prompt, Resolution, CappedList
+from models import Prompt, Resolution
+from post_pipeline import PostPipeline
+from http_client import HttpClient, HostConfig
 
 
 THROTTLE_RATE_IMAGE = 5
 CHAT_HISTORY_SIZE = 10
 THROTTLE_RATE_MESSAGE = 1
+# same limits as with dp.throttled, chat wide limits can be added with chat_rate and chat_burst
+MESSAGE_LIMITS = dict(rate=THROTTLE_RATE_MESSAGE)
+IMAGE_LIMITS = dict(rate=THROTTLE_RATE_IMAGE)
 MAX_IMAGE_SIZE = 2048
 MAX_CAPTION_SIZE = 1024
 BLOG_ID = "Telegram"
 GROUP_NAME = "@motya_blog"
 DEFAULT_PROMPT = Prompt("")
 IMAGE_CAPTION = "готово 🎨🐾"
+PHOTO = "photo"
+DOCUMENT = "document"
+DRAWING_STATUS = "рисую ✏️🐾 ..."
+# status message with queue position is edited at most once in this many seconds
+QUEUE_STATUS_INTERVAL_S = 3
+GENERATION_ERROR = "ошибка 🥶"
+CONNECTION_ERROR = "не могу найти свой карандаш и краски 😭"
 
 TOKEN = os.getenv("TG_TOKEN")
 ADMIN_ID = int(os.getenv("ADMIN_ID"))
 MONGO_URL = os.getenv("MONGO_URL")
 DB_NAME = "motya_gpt"
-
-bot = Bot(TOKEN, parse_mode="HTML")
+TG_API_URL = os.getenv("TG_API_URL")
+SHUTDOWN_TIMEOUT_S = float(os.getenv("SHUTDOWN_TIMEOUT_S", 30))
+# scheduled posts and inspirations for them are turned off in load tests
+SCHEDULED_POSTS = os.getenv("SCHEDULED_POSTS", "1") == "1"
+
+bot = Bot(
+    TOKEN, 
+    parse_mode="HTML", 
+    server=TelegramAPIServer.from_base(TG_API_URL) if TG_API_URL else TELEGRAM_PRODUCTION
+)
 # dp = Dispatcher(bot, storage=MemoryStorage())
 dp = Dispatcher(bot, storage=MongoStorage(uri=MONGO_URL, db_name=DB_NAME))
 bot_config_db = BotConfigDb(MONGO_URL, DB_NAME, "config")
 user_config_db = UserConfigDb(MONGO_URL, DB_NAME, "user_config")
 news_history_db = NewsHistoryDb(MONGO_URL, DB_NAME, "news_history")
+inspirations_db = InspirationsDb(MONGO_URL, DB_NAME, "inspirations")
+post_queue_db = PostQueueDb(MONGO_URL, DB_NAME, "post_queue")
+image_file_db = ImageFileDb(MONGO_URL, DB_NAME, "image_files")
+chat_history_db = ChatHistoryDb(MONGO_URL, DB_NAME, "chat_history", max_store=CHAT_HISTORY_SIZE)
+http_client = HttpClient({
+    URL(ImageGenerator.RUN_URL).host: HostConfig(limit=20, keepalive_timeout_s=60),
+    URL(NewsParser.BASE_URL).host: HostConfig(limit=2),
+})
+transcoder = Transcoder()
+rate_limiter = RateLimiter.from_env()
 logger = logging.getLogger("bot")
+# references to running tasks, so they aren't garbage collected
+background_tasks: set[asyncio.Task] = set()
+image_deliveries: set[asyncio.Task] = set()
+
+
+def run_in_background(coro: Awaitable, tasks: set[asyncio.Task] = background_tasks) -> asyncio.Task:
+    """Background tasks are cancelled on shutdown, image deliveries get time to finish"""
+    task = asyncio.create_task(coro)
+    tasks.add(task)
+    task.add_done_callback(tasks.discard)
+    return task
+
+
+def image_hash(image: bytes) -> str:
+    return hashlib.sha256(image).hexdigest()
+
+
+async def input_image(
+    image: bytes, kind: str = PHOTO, filename: str = "image", reuse: bool = True
+) -> tuple[str | types.InputFile, types.InputFile | None]:
+    """Returns file id of image if it was already uploaded to Telegram, otherwise transcoded file to upload
+    and its thumbnail"""
+    file_id = await image_file_db.get_file_id(image_hash(image), kind) if reuse else None
+    if file_id:
+        return file_id, None
+    transcoded = await transcoder.transcode(image, thumbnail=kind == DOCUMENT)
+    thumbnail = types.InputFile(io.BytesIO(transcoded.thumbnail), "thumbnail.jpg") if transcoded.thumbnail else None
+    return types.InputFile(io.BytesIO(transcoded.image), f"{filename}.{transcoded.extension}"), thumbnail
+
+
+async def remember_file_ids(images: list[bytes], messages: list[types.Message], kind: str = PHOTO) -> None:
+    for image, message in zip(images, messages):
+        file_id = message.photo[-1].file_id if kind == PHOTO else message.document.file_id
+        await image_file_db.set_file_id(image_hash(image), kind, file_id)
+
+
+async def forget_file_ids(images: list[bytes], kind: str = PHOTO) -> bool:
+    """Returns True if any of images had file id"""
+    return bool(await image_file_db.forget_file_ids([image_hash(image) for image in images], kind))
 
 
-def create_media(images: list[bytes], caption: str = None) -> types.MediaGroup:
+async def create_media(images: list[bytes], caption: str = None, reuse: bool = True) -> types.MediaGroup:
+    files = await asyncio.gather(*(input_image(image, reuse=reuse) for image in images))
     media = types.MediaGroup()
-    media.attach_photo(types.InputFile(io.BytesIO((images[0])), "image.png"), caption)
-    for image in images[1:]:
-        media.attach_photo(types.InputFile(io.BytesIO(image), "image.png"))
+    media.attach_photo(files[0][0], caption)
+    for file_, _ in files[1:]:
+        media.attach_photo(file_)
     return media
 
 
-async def send_post(model: AsyncMotyaModel, group: str | int = None):
-    themes = bot_config_db.get_themes()
-    styles = bot_config_db.get_image_styles()    
-    images = random.choice([1, 3])
-
+async def send_post(pipeline: PostPipeline, group: str | int = None):
     group = GROUP_NAME if not group else group
 
-    post = await model.create_random_post_with_images(themes, images, styles)
-    if not images:
+    post = await pipeline.pop()
+    if not post.images:
         await bot.send_message(group, post.text)
         return
         
-    if len(post.text) < MAX_CAPTION_SIZE:
-        media = create_media(post.images, post.text)
-        await bot.send_media_group(group, media)
-    else:
-        media = create_media(post.images)
-        await bot.send_media_group(group, media)
+    caption = post.text if len(post.text) < MAX_CAPTION_SIZE else None
+    try:
+        messages = await bot.send_media_group(group, await create_media(post.images, caption))
+    except BadRequest as e:
+        # stored file ids become invalid e.g. when bot token changes
+        if not await forget_file_ids(post.images):
+            raise
+        logger.warning(f"Uploading post images again, file ids were rejected: {e}")
+        messages = await bot.send_media_group(group, await create_media(post.images, caption, reuse=False))
+    if caption is None:
         await bot.send_message(group, post.text)
+    await remember_file_ids(post.images, messages)
 
 
 async def send_news(model: AsyncMotyaModel, group: str | int = None):
-    excluded_urls = news_history_db.get_excluded_urls()
-    post_text, url = await model.get_random_article_description(excluded_urls)
+    post_text, url = await model.get_random_article_description()
     post_text = f"{post_text}\n\n#новостиотмоти"
 
     group = GROUP_NAME if not group else group
 
     await bot.send_message(group, post_text)
-    news_history_db.add_article_url(url)
+    await news_history_db.add_article_url(url)
 
 
 async def posts_loop(model: AsyncMotyaModel):
+    pipeline = PostPipeline(model, bot_config_db, post_queue_db)
+    run_in_background(pipeline.run())
     for time in ["11:50", "14:05", "16:45", "19:05"]:
-        aioschedule.every().day.at(time).do(send_post, model, None)
+        aioschedule.every().day.at(time).do(send_post, pipeline, None)
     aioschedule.every().day.at("8:10").do(send_news, model, None)
     while True:
         await aioschedule.run_pending()
@@ -95,11 +175,19 @@ async def posts_loop(model: AsyncMotyaModel):
 
 
 async def on_startup(dp: Dispatcher):
-    image_gen = ImageGenerator()
-    news_parser = NewsParser()
-    motya = await AsyncMotyaModel.create(image_gen, news_parser)
+    image_gen = ImageGenerator(http_client, image_cache=ImageCache())
+    news_parser = NewsParser(http_client, news_history_db)
+    await bot_config_db.load()
+    run_in_background(bot_config_db.watch())
+    await user_config_db.ensure_indexes()
+    await news_history_db.ensure_indexes()
+    run_in_background(user_config_db.run_flusher())
+    motya = await AsyncMotyaModel.create(image_gen, news_parser, inspirations_db=inspirations_db)
+    dp["model"] = motya
     dp.middleware.setup(ModelMiddleware(motya))
-    asyncio.create_task(posts_loop(motya))
+    if SCHEDULED_POSTS:
+        run_in_background(motya.inspirations.fill(await bot_config_db.get_themes() or []))
+        run_in_background(posts_loop(motya))
     basic_commands = [
         types.BotCommand("start", "Поприветствовать Мотю"),
         types.BotCommand("draw", "Нарисовать картинку по запросу"),
@@ -120,6 +208,33 @@ async def on_startup(dp: Dispatcher):
     )
 
 
+async def on_shutdown(dp: Dispatcher):
+    if image_deliveries:
+        logger.info(f"Waiting for {len(image_deliveries)} images to be delivered")
+        _, pending = await asyncio.wait(image_deliveries, timeout=SHUTDOWN_TIMEOUT_S)
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+    # loops use Mongo and the model, so they are stopped before those are closed
+    tasks = list(background_tasks)
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    model: AsyncMotyaModel | None = dp.get("model")
+    if model is not None:
+        logger.info(f"Model: {model.stats()}")
+        await model.close()
+    logger.info(f"HTTP connections: {http_client.stats()}")
+    logger.info(f"Transcoded images: {transcoder.stats()}")
+    await user_config_db.close()
+    logger.info(f"User configs: {user_config_db.stats()}")
+    logger.info(f"Throttling: {rate_limiter.stats()}")
+    await rate_limiter.close()
+    await http_client.close()
+    close_clients()
+    transcoder.close()
+
+
 async def on_draw_spam(message, *args, **kwargs):
     await message.reply(f"ой 🙄 команду /draw можно нажимать не чаще чем раз в {THROTTLE_RATE_IMAGE} секунд 😝")
 
@@ -129,7 +244,7 @@ async def on_message_spam(message, *args, **kwargs):
 
 
 @dp.message_handler(commands=["start"])
-@dp.throttled(on_message_spam, rate=THROTTLE_RATE_MESSAGE)
+@rate_limiter.throttled(on_message_spam, **MESSAGE_LIMITS)
 async def send_start(message: types.Message, model: AsyncMotyaModel):
     await types.ChatActions.typing()
     answer =  \
@@ -152,7 +267,7 @@ def validate_resolution(res: list[str]) -> Resolution:
     return Resolution(w, h)
 
 
-def parse_args(args: str) -> Prompt | None:
+def parse_args(args: str) -> tuple[Prompt | None, bool]:
     args = args.split()
     parser = argparse.ArgumentParser()
     parser.add_argument("text", nargs="*")
@@ -169,175 +284,235 @@ def parse_args(args: str) -> Prompt | None:
         help="image resolution", 
         default=DEFAULT_PROMPT.resolution
     )
+    parser.add_argument(
+        "-new", "-n",
+        action="store_true",
+        help="draw new image even if the same was drawn before",
+    )
     args, _ = parser.parse_known_args(args)
 
     if not args.text:
-        return
+        return None, args.new
 
     res = validate_resolution(args.res)
-    return Prompt(" ".join(args.text), " ".join(args.style), res)
+    return Prompt(" ".join(args.text), " ".join(args.style), res), args.new
 
 
 @dp.message_handler(commands=["style"])
-@dp.throttled(on_message_spam, rate=THROTTLE_RATE_MESSAGE)
+@rate_limiter.throttled(on_message_spam, **MESSAGE_LIMITS)
 async def set_style(message: types.Message):
     style = message.get_args()
-    user_config_db.set_style(message.from_id, style)
+    await user_config_db.set_style(message.from_id, style)
     await message.reply("поменял стандартный стиль 🥰")
 
 
 @dp.message_handler(commands=["res"])
-@dp.throttled(on_message_spam, rate=THROTTLE_RATE_MESSAGE)
+@rate_limiter.throttled(on_message_spam, **MESSAGE_LIMITS)
 async def set_style(message: types.Message):
     args = message.get_args()
     if not args:
-        user_config_db.set_resolution(message.from_id, Resolution())
+        await user_config_db.set_resolution(message.from_id, Resolution())
         await message.reply("поставил стандартное разрешение изображения ✅🥰")
         return
     res = validate_resolution(args.split())
-    user_config_db.set_resolution(message.from_id, res)
+    await user_config_db.set_resolution(message.from_id, res)
     await message.reply("поменял стандартное разрешение изображения 🥰")
 
 
 @dp.message_handler(commands=["draw"])
-@dp.throttled(on_draw_spam ,rate=THROTTLE_RATE_IMAGE)
+@rate_limiter.throttled(on_draw_spam, **IMAGE_LIMITS)
 async def send_image(message: types.Message, model: AsyncMotyaModel):
-    prompt = parse_args(message.get_args())
+    prompt, force_new = parse_args(message.get_args())
     if not prompt:
         msg = await message.answer("думаю 🐾 ...")
         answer = await model.answer(
-            "напиши: чтобы нарисовать что-то, нужно отправить вместе с командой /draw то, что хочешь нарисовать"
+            "напиши: чтобы нарисовать что-то, нужно отправить вместе с командой /draw то, что хочешь нарисовать",
+            cached=True
         )
         await message.reply(answer)
         await msg.delete()
         return
 
-    user_conf = user_config_db.get_user_config(message.from_id)
+    user_conf = await user_config_db.get_user_config(message.from_id)
     if prompt.is_default():
         prompt = Prompt(prompt.text, user_conf.style, user_conf.resolution)
 
-    user_config_db.set_last_image(message.from_id, prompt.description)
-    msg = await message.answer("рисую ✏️🐾 ...")
-    image_bytes = await model.image_gen.get_images([prompt])
-    file_ = types.InputFile(io.BytesIO(image_bytes[0]), f"{prompt.text}.png")
-    
-    if prompt.resolution == DEFAULT_PROMPT.resolution:
-        await message.reply_photo(file_, caption=IMAGE_CAPTION)
-    else:
-        await message.reply_document(file_, caption=IMAGE_CAPTION)
-    
-    await msg.delete()
+    await user_config_db.set_last_image(message.from_id, prompt.description)
+    job = model.image_queue.submit(message.from_id, [prompt], force_new)
+    msg = await message.answer(queue_status(model.image_queue.position(job)))
+    run_in_background(deliver_image(message, msg, job, prompt, model.image_queue), image_deliveries)
+
+
+def queue_status(position: int) -> str:
+    if position > 0:
+        return f"жду своей очереди, передо мной {position} 🎨🐾 ..."
+    return DRAWING_STATUS
+
+
+async def wait_for_turn(msg: types.Message, job: ImageJob, queue: ImageJobQueue):
+    """Keeps queue position in status message up to date until job starts"""
+    shown = queue.position(job)
+    while not job.started.is_set():
+        await queue.wait_taken()
+        position = queue.position(job)
+        if job.started.is_set() or position == shown:
+            continue
+        shown = position
+        await ignore_errors(msg.edit_text(queue_status(position)), "edit status message")
+        try:
+            await asyncio.wait_for(job.started.wait(), QUEUE_STATUS_INTERVAL_S)
+        except asyncio.TimeoutError:
+            pass
+
+
+async def ignore_errors(awaitable: Awaitable, action: str):
+    """Status messages aren't worth failing delivery of an image"""
+    try:
+        await awaitable
+    except Exception as e:
+        logger.warning(f"Can't {action}: {e!r}")
+
+
+async def reply_image(message: types.Message, image: bytes, kind: str, filename: str, reuse: bool = True):
+    file_, thumbnail = await input_image(image, kind, filename, reuse)
+    try:
+        if kind == PHOTO:
+            sent = await message.reply_photo(file_, caption=IMAGE_CAPTION)
+        else:
+            sent = await message.reply_document(file_, thumb=thumbnail, caption=IMAGE_CAPTION)
+    except BadRequest as e:
+        if not isinstance(file_, str):
+            raise
+        logger.warning(f"Uploading image again, file id was rejected: {e}")
+        await forget_file_ids([image], kind)
+        return await reply_image(message, image, kind, filename, reuse=False)
+    if not isinstance(file_, str):
+        await remember_file_ids([image], [sent], kind)
+
+
+async def deliver_image(
+    message: types.Message, msg: types.Message, job: ImageJob, prompt: Prompt, queue: ImageJobQueue
+):
+    """Waits for queued image job and replies with its image, handler doesn't wait for it"""
+    try:
+        if not job.started.is_set():
+            await wait_for_turn(msg, job, queue)
+            if not job.future.done():
+                await ignore_errors(msg.edit_text(DRAWING_STATUS), "edit status message")
+        image_bytes = await job.future
+        kind = PHOTO if prompt.resolution == DEFAULT_PROMPT.resolution else DOCUMENT
+        await reply_image(message, image_bytes[0], kind, prompt.text)
+    except Exception as e:
+        # handler has already returned, so errors handlers are called here
+        if not await dp.errors_handlers.notify(types.Update.get_current(), e):
+            logger.error(f"Failed to deliver image to {message.from_id}: {e!r}")
+    finally:
+        await ignore_errors(msg.delete(), "delete status message")
 
 
 @dp.message_handler(IDFilter(ADMIN_ID), commands=["prompt"])
 async def prompt(message: types.Message, model: AsyncMotyaModel):
-    current = bot_config_db.get_main_prompt()
+    current = await bot_config_db.get_main_prompt()
     await message.reply(current)
     new = message.get_args()
     if not new:
         return
-    bot_config_db.set_main_prompt(new)
+    await bot_config_db.set_main_prompt(new)
     await model.reset_model(new)
     await message.reply("обновил 🤗")
 
 
 @dp.message_handler(IDFilter(ADMIN_ID), commands=["themes"])
 async def prompt(message: types.Message):
-    current = "\n".join(bot_config_db.get_themes())
+    current = "\n".join(await bot_config_db.get_themes())
     new = message.get_args()
     await message.reply(current)
     if not new:
         return
-    bot_config_db.add_themes(
+    await bot_config_db.add_themes(
         [theme.strip() for theme in new.split(",")])
     await message.reply("добавил темы 🤗")
 
 
 @dp.message_handler(IDFilter(ADMIN_ID), commands=["test"])
 async def test(message: types.Message, model: AsyncMotyaModel):
-    # await send_post(model, message.from_id)
+    # await send_post(PostPipeline(model, bot_config_db, post_queue_db), message.from_id)
     await send_news(model, message.from_id)
 
 
-async def save_history(data, messages: list[str]):
-    history = CappedList([*data.get("history", []), *messages], max_store=CHAT_HISTORY_SIZE)
-    data["history"] = history
+async def save_history(message: types.Message, messages: list[str]):
+    await chat_history_db.add_messages(message.chat.id, message.from_id, messages)
 
 
 @dp.message_handler(commands=["clear"])
-async def reset_history(message: types.Message, state: FSMContext):
-    async with state.proxy() as data:
-        data["history"] = []
+async def reset_history(message: types.Message):
+    await chat_history_db.clear(message.chat.id, message.from_id)
     await message.reply("отчистил историю сообщений 🫡")
 
 
 @dp.message_handler(ChatTypeFilter(types.ChatType.PRIVATE))
-@dp.throttled(on_message_spam, rate=THROTTLE_RATE_MESSAGE)
-async def reply_to_message_privately(message: types.Message, model: AsyncMotyaModel, state: FSMContext):
+@rate_limiter.throttled(on_message_spam, **MESSAGE_LIMITS)
+async def reply_to_message_privately(message: types.Message, model: AsyncMotyaModel):
     logger.info(f"Answering to {message.from_id} in chat {message.chat.id}")
     await types.ChatActions.typing()
     msg = await message.answer("секундочку 🐾 ...")
-    async with state.proxy() as data:
-        history = data.get("history", [])
-        answer = await model.answer_with_history(message.text, history)
-        await message.reply(answer)
-        await save_history(data, [message.text, answer])
-        await msg.delete()
+    history = await chat_history_db.get_history(message.chat.id, message.from_id)
+    answer = await model.answer_with_history(message.text, history)
+    await message.reply(answer)
+    await save_history(message, [message.text, answer])
+    await msg.delete()
 
 
-async def reply_to_question_in_chat(message: types.Message, model: AsyncMotyaModel, state: FSMContext):
+async def reply_to_question_in_chat(message: types.Message, model: AsyncMotyaModel):
     logger.info(f"Answering to {message.from_id} in chat {message.chat.id}")
     await types.ChatActions.typing()
-    async with state.proxy() as data:
-        history = data.get("history", [])
-        answer = await model.answer_with_history(message.text, history)
-        await message.reply(answer)
-        await save_history(data, [message.text, answer])
+    history = await chat_history_db.get_history(message.chat.id, message.from_id)
+    answer = await model.answer_with_history(message.text, history)
+    await message.reply(answer)
+    await save_history(message, [message.text, answer])
 
 
-async def reply_to_one_message(message: types.Message, model: AsyncMotyaModel, state: FSMContext):
+async def reply_to_one_message(message: types.Message, model: AsyncMotyaModel):
     logger.info(f"Answering to one message from {message.from_id} in chat {message.chat.id}")
     await types.ChatActions.typing()
     answer = await model.answer(f"ты писал про: {message.reply_to_message.text}, ответь на: {message.text}")
     await message.reply(answer)
-    async with state.proxy() as data:
-        await save_history(data, [message.text, answer])
+    await save_history(message, [message.text, answer])
 
 
-async def reply_to_drawing(message: types.Message, model: AsyncMotyaModel, state: FSMContext):
+async def reply_to_drawing(message: types.Message, model: AsyncMotyaModel):
     logger.info(f"Answering to drawing from {message.from_id} in chat {message.chat.id}")
     await types.ChatActions.typing()
-    config = user_config_db.get_user_config(message.from_id)
+    config = await user_config_db.get_user_config(message.from_id)
     answer = await model.answer(f"ты нарисовал рисунок по запросу: '{config.last_image}', ответь на: {message.text}")
     await message.reply(answer)
-    async with state.proxy() as data:
-        await save_history(data, [message.text, answer])
+    await save_history(message, [message.text, answer])
     
 
 @dp.message_handler(IsReplyFilter(True))
-@dp.throttled(on_message_spam, rate=THROTTLE_RATE_MESSAGE)
-async def handle_reply_in_chat(message: types.Message, model: AsyncMotyaModel, state: FSMContext):
+@rate_limiter.throttled(on_message_spam, **MESSAGE_LIMITS)
+async def handle_reply_in_chat(message: types.Message, model: AsyncMotyaModel):
     reply_from_user = message.reply_to_message.from_user
     if reply_from_user.id != bot.id and reply_from_user.full_name != BLOG_ID:
         return
     elif reply_from_user.full_name == BLOG_ID:
-        await reply_to_one_message(message, model, message.reply_to_message)        
+        await reply_to_one_message(message, model)        
         return
     elif message.reply_to_message.caption is not None:
-        await reply_to_drawing(message, model, message.reply_to_message)
+        await reply_to_drawing(message, model)
         return
-    await reply_to_question_in_chat(message, model, state)
+    await reply_to_question_in_chat(message, model)
 
 
 @dp.message_handler(commands=["ask"])
-@dp.throttled(on_message_spam, rate=THROTTLE_RATE_MESSAGE)
-async def handle_ask_command_in_chat(message: types.Message, model: AsyncMotyaModel, state: FSMContext):
+@rate_limiter.throttled(on_message_spam, **MESSAGE_LIMITS)
+async def handle_ask_command_in_chat(message: types.Message, model: AsyncMotyaModel):
     if message.get_command():
         message.text = message.get_args()
         if not message.text:
             await message.reply("на что вы хотите чтобы я ответил? 🤓")
             return 
-    await reply_to_question_in_chat(message, model, state)
+    await reply_to_question_in_chat(message, model)
 
 
 async def basic_error(update: types.Update, error_msg: str):
@@ -351,12 +526,17 @@ async def basic_error(update: types.Update, error_msg: str):
 
 @dp.errors_handler(exception=ImageGenerationError)
 async def generation_error(update: types.Update, error):
-    await basic_error(update, f"ошибка 🥶 {error}")
+    await basic_error(update, f"{GENERATION_ERROR} {error}")
 
 
 @dp.errors_handler(exception=ClientConnectionError)
 async def connection_error(update: types.Update, error):
-    await basic_error(update, f"не могу найти свой карандаш и краски 😭")
+    await basic_error(update, CONNECTION_ERROR)
+
+
+@dp.errors_handler(exception=CircuitOpenError)
+async def model_unavailable_error(update: types.Update, error):
+    await basic_error(update, f"ой 😴 мотя сейчас немного устал, попробуйте написать чуть позже 🥺")
 
 
 @dp.errors_handler(exception=ProgrammingError)
@@ -368,4 +548,4 @@ if __name__ == "__main__":
     from dotenv import load_dotenv
     load_dotenv()
     
-    bot_config_db.add_themes()
+    asyncio.run(bot_config_db.add_themes([]))
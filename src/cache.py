@@ -0,0 +1,57 @@
+from collections import OrderedDict
+from typing import Any, Hashable
+import time
+
+
+class TTLCache:
+    """Bounded LRU cache where every entry also expires after `ttl` seconds"""
+    def __init__(self, max_size: int = 256, ttl: float = 3600) -> None:
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data: OrderedDict[Hashable, tuple[float, Any]] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return self.get(key, count=False) is not None
+
+    def get(self, key: Hashable, count: bool = True) -> Any | None:
+        item = self._data.get(key)
+        if item is not None and item[0] < time.monotonic():
+            del self._data[key]
+            self.evictions += 1
+            item = None
+
+        if item is None:
+            self.misses += count
+            return None
+
+        self._data.move_to_end(key)
+        self.hits += count
+        return item[1]
+
+    def set(self, key: Hashable, value: Any) -> None:
+        self._data[key] = (time.monotonic() + self.ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def pop(self, key: Hashable) -> Any | None:
+        item = self._data.pop(key, None)
+        return item[1] if item is not None else None
+
+    def clear(self) -> None:
+        self._data.clear()
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "size": len(self._data),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
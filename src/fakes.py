@@ -0,0 +1,426 @@
+"""Local stand-ins for MindsDB, FusionBrain, positivnews.ru and Telegram Bot API.
+
+Run `python fakes.py` and point the bot at them with the printed env variables,
+or use `load_test.py` which starts them in-process.
+"""
+from typing import Callable, NamedTuple
+import argparse
+import asyncio
+import base64
+import itertools
+import json
+import logging
+import random
+import re
+import struct
+import time
+import uuid
+import zlib
+
+from aiohttp import web
+
+
+logger = logging.getLogger("fakes")
+
+
+class FakeConfig(NamedTuple):
+    # seconds, every response waits uniformly between latency and latency * 2
+    latency_s: float = 0.0
+    error_rate: float = 0.0
+
+    async def delay(self) -> None:
+        if self.latency_s:
+            await asyncio.sleep(random.uniform(self.latency_s, self.latency_s * 2))
+
+    def fails(self) -> bool:
+        return random.random() < self.error_rate
+
+
+def default_responder(model_name: str, text: str) -> str:
+    # answers can be split by "," for themes and by ";" for pictures like real ones
+    return f"мотя отвечает на: {text[:40]}, котик; щенок; тушканчик"
+
+
+# MindsDB
+
+CLIENT_CAPABILITIES = (
+    0x00000001  # LONG_PASSWORD
+    | 0x00000004  # LONG_FLAG
+    | 0x00000008  # CONNECT_WITH_DB
+    | 0x00000200  # PROTOCOL_41
+    | 0x00002000  # TRANSACTIONS
+    | 0x00008000  # SECURE_CONNECTION
+    | 0x00020000  # MULTI_RESULTS
+    | 0x00080000  # PLUGIN_AUTH
+)
+SERVER_STATUS_AUTOCOMMIT = 0x0002
+UTF8MB4 = 45
+VAR_STRING = 0xfd
+COM_QUIT = 0x01
+COM_QUERY = 0x03
+ER_UNKNOWN_ERROR = 1105
+
+SINGLE_QUERY = re.compile(r'SELECT\s+(?:(\d+)\s+AS\s+idx,\s*)?response\s+FROM\s+(\S+)\s+WHERE\s+text="(.*)";?\s*$', re.I | re.S)
+BATCH_QUERY = re.compile(r"JOIN\s+(\S+)\s+AS\s+m", re.I)
+BATCH_INPUT = re.compile(r'SELECT\s+(\d+)\s+AS\s+idx,\s*"(.*?)"\s+AS\s+text', re.I | re.S)
+
+
+def _lenenc_int(value: int) -> bytes:
+    if value < 251:
+        return bytes([value])
+    if value < 2 ** 16:
+        return b"\xfc" + struct.pack("<H", value)
+    if value < 2 ** 24:
+        return b"\xfd" + struct.pack("<I", value)[:3]
+    return b"\xfe" + struct.pack("<Q", value)
+
+
+def _lenenc_str(value: str | bytes) -> bytes:
+    value = value.encode() if isinstance(value, str) else value
+    return _lenenc_int(len(value)) + value
+
+
+class FakeMindsDb:
+    """Speaks enough of MySQL protocol to answer prediction queries of AsyncMotyaModel"""
+    def __init__(
+        self,
+        config: FakeConfig = FakeConfig(),
+        responder: Callable[[str, str], str] = default_responder,
+    ) -> None:
+        self.config = config
+        self.responder = responder
+        self.queries = 0
+        self.errors = 0
+        self.connections = 0
+        self.server: asyncio.AbstractServer | None = None
+        self._ids = itertools.count(1)
+        self._writers: set[asyncio.StreamWriter] = set()
+
+    @property
+    def port(self) -> int:
+        return self.server.sockets[0].getsockname()[1]
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> None:
+        self.server = await asyncio.start_server(self._handle, host, port)
+
+    async def close(self) -> None:
+        self.server.close()
+        for writer in list(self._writers):
+            writer.close()
+            await writer.wait_closed()
+        await self.server.wait_closed()
+
+    @staticmethod
+    def _write(writer: asyncio.StreamWriter, seq: int, payload: bytes) -> int:
+        writer.write(struct.pack("<I", len(payload))[:3] + bytes([seq]) + payload)
+        return seq + 1
+
+    @staticmethod
+    async def _read(reader: asyncio.StreamReader) -> tuple[int, bytes]:
+        header = await reader.readexactly(4)
+        length = int.from_bytes(header[:3], "little")
+        return header[3], await reader.readexactly(length)
+
+    @staticmethod
+    def _ok() -> bytes:
+        return b"\x00" + _lenenc_int(0) + _lenenc_int(0) + struct.pack("<HH", SERVER_STATUS_AUTOCOMMIT, 0)
+
+    @staticmethod
+    def _eof() -> bytes:
+        return b"\xfe" + struct.pack("<HH", 0, SERVER_STATUS_AUTOCOMMIT)
+
+    @staticmethod
+    def _error(message: str, code: int = ER_UNKNOWN_ERROR) -> bytes:
+        return b"\xff" + struct.pack("<H", code) + b"#HY000" + message.encode()
+
+    def _handshake(self) -> bytes:
+        salt = bytes(random.randrange(1, 128) for _ in range(20))
+        return b"".join([
+            b"\x0a",
+            b"8.0.0-fake-mindsdb\x00",
+            struct.pack("<I", next(self._ids)),
+            salt[:8] + b"\x00",
+            struct.pack("<H", CLIENT_CAPABILITIES & 0xffff),
+            bytes([UTF8MB4]),
+            struct.pack("<H", SERVER_STATUS_AUTOCOMMIT),
+            struct.pack("<H", CLIENT_CAPABILITIES >> 16),
+            bytes([len(salt) + 1]),
+            b"\x00" * 10,
+            salt[8:] + b"\x00",
+            b"mysql_native_password\x00",
+        ])
+
+    def _result_set(self, seq: int, writer: asyncio.StreamWriter, columns: list[str], rows: list[tuple]) -> None:
+        seq = self._write(writer, seq, _lenenc_int(len(columns)))
+        for column in columns:
+            definition = b"".join([
+                _lenenc_str("def"), _lenenc_str("mindsdb"), _lenenc_str("t"), _lenenc_str("t"),
+                _lenenc_str(column), _lenenc_str(column),
+                b"\x0c", struct.pack("<HIBHB", UTF8MB4, 65535, VAR_STRING, 0, 0), b"\x00\x00",
+            ])
+            seq = self._write(writer, seq, definition)
+        seq = self._write(writer, seq, self._eof())
+        for row in rows:
+            seq = self._write(writer, seq, b"".join(_lenenc_str(str(value)) for value in row))
+        self._write(writer, seq, self._eof())
+
+    def _answer(self, query: str) -> tuple[list[str], list[tuple]] | None:
+        if match := SINGLE_QUERY.search(query):
+            idx, model_name, text = match.groups()
+            response = self.responder(model_name, text)
+            if idx is None:
+                return ["response"], [(response,)]
+            return ["idx", "response"], [(idx, response)]
+        if match := BATCH_QUERY.search(query):
+            model_name = match.group(1)
+            rows = [(idx, self.responder(model_name, text)) for idx, text in BATCH_INPUT.findall(query)]
+            return ["idx", "response"], rows
+        return None
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        self.connections += 1
+        self._writers.add(writer)
+        try:
+            self._write(writer, 0, self._handshake())
+            seq, _ = await self._read(reader)
+            self._write(writer, seq + 1, self._ok())
+            while True:
+                seq, payload = await self._read(reader)
+                command, body = payload[0], payload[1:]
+                if command == COM_QUIT:
+                    break
+                if command != COM_QUERY:
+                    self._write(writer, seq + 1, self._ok())
+                    continue
+
+                result = self._answer(body.decode())
+                if result is None:
+                    self._write(writer, seq + 1, self._ok())
+                    continue
+
+                self.queries += 1
+                await self.config.delay()
+                if self.config.fails():
+                    self.errors += 1
+                    self._write(writer, seq + 1, self._error("fake MindsDB failure"))
+                else:
+                    self._result_set(seq + 1, writer, *result)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self._writers.discard(writer)
+            writer.close()
+
+
+# FusionBrain
+
+def make_png(width: int = 8, height: int = 8, color: tuple[int, int, int] = (255, 170, 200)) -> bytes:
+    def chunk(kind: bytes, data: bytes) -> bytes:
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+
+    row = b"\x00" + bytes(color) * width
+    return b"".join([
+        b"\x89PNG\r\n\x1a\n",
+        chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)),
+        chunk(b"IDAT", zlib.compress(row * height)),
+        chunk(b"IEND", b""),
+    ])
+
+
+def create_fusion_brain_app(config: FakeConfig = FakeConfig(), generation_s: float = 1.0) -> web.Application:
+    """Jobs become SUCCESS after `generation_s` seconds, `config.latency_s` is added to every request"""
+    pockets: dict[str, tuple[float, int, int]] = {}
+    stats = {"run": 0, "status": 0, "entities": 0, "errors": 0}
+
+    async def run(request: web.Request) -> web.Response:
+        stats["run"] += 1
+        await config.delay()
+        if config.fails():
+            stats["errors"] += 1
+            return web.json_response({"error": "fake FusionBrain failure"}, status=500)
+        data = await request.json()
+        pocket_id = str(uuid.uuid4())
+        # real pictures are too big for load tests, size is scaled down
+        pockets[pocket_id] = (time.monotonic() + generation_s, data["width"] // 32, data["height"] // 32)
+        return web.json_response({"result": {"pocketId": pocket_id}}, status=201)
+
+    async def status(request: web.Request) -> web.Response:
+        stats["status"] += 1
+        await config.delay()
+        ready_at, *_ = pockets[request.match_info["pocket_id"]]
+        return web.json_response({"result": "SUCCESS" if time.monotonic() >= ready_at else "PROCESSING"})
+
+    async def entities(request: web.Request) -> web.Response:
+        stats["entities"] += 1
+        await config.delay()
+        _, width, height = pockets.pop(request.match_info["pocket_id"])
+        image = base64.b64encode(make_png(width, height)).decode()
+        return web.json_response({"result": [{"response": [image]}]})
+
+    app = web.Application()
+    app["stats"] = stats
+    app.router.add_post("/api/v1/text2image/run", run)
+    app.router.add_get("/api/v1/text2image/inpainting/pockets/{pocket_id}/status", status)
+    app.router.add_get("/api/v1/text2image/inpainting/pockets/{pocket_id}/entities", entities)
+    return app
+
+
+# positivnews.ru
+
+def create_news_app(config: FakeConfig = FakeConfig(), articles: int = 20) -> web.Application:
+    async def index(request: web.Request) -> web.Response:
+        await config.delay()
+        base = request.url.origin()
+        posts = "\n".join(
+            f'<article><h2 class="post-title"><a href="{base}/news/{i}">новость {i}</a></h2>'
+            f'<a href="{base}/news/{i}"><time class="entry-date">{i}.01.2024</time></a></article>'
+            for i in range(articles)
+        )
+        return web.Response(text=f"<html><body>{posts}</body></html>", content_type="text/html")
+
+    app = web.Application()
+    app.router.add_get("/", index)
+    return app
+
+
+# Telegram Bot API
+
+def create_telegram_app(config: FakeConfig = FakeConfig()) -> web.Application:
+    """Accepts every Bot API method and answers with minimal valid objects"""
+    message_ids = itertools.count(1)
+    file_ids = itertools.count(1)
+    stats: dict[str, int] = {}
+
+    def message(chat_id: str, **extra) -> dict:
+        return {
+            "message_id": next(message_ids),
+            "date": int(time.time()),
+            "chat": {"id": int(chat_id), "type": "private"},
+            **extra,
+        }
+
+    def file(**extra) -> dict:
+        file_id = next(file_ids)
+        return {"file_id": f"file-{file_id}", "file_unique_id": f"unique-{file_id}", **extra}
+
+    async def handle(request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        stats[method] = stats.get(method, 0) + 1
+        data = await request.post() if request.can_read_body else {}
+        await config.delay()
+        if config.fails():
+            return web.json_response(
+                {"ok": False, "error_code": 500, "description": "Internal Server Error: fake failure"}
+            )
+
+        chat_id = data.get("chat_id", "1")
+        match method:
+            case "getMe":
+                result = {"id": 1, "is_bot": True, "first_name": "motya", "username": "motya_bot"}
+            case "sendMessage" | "editMessageText":
+                result = message(chat_id, text=data.get("text", ""))
+            case "sendPhoto":
+                result = message(chat_id, photo=[file(width=768, height=768)])
+            case "sendDocument":
+                result = message(chat_id, document=file())
+            case "sendMediaGroup":
+                media = json.loads(data.get("media", "[]"))
+                result = [message(chat_id, photo=[file(width=768, height=768)]) for _ in media]
+            case "getUpdates":
+                await asyncio.sleep(1)
+                result = []
+            case _:
+                result = True
+        return web.json_response({"ok": True, "result": result})
+
+    app = web.Application()
+    app["stats"] = stats
+    app.router.add_post("/bot{token}/{method}", handle)
+    return app
+
+
+class FakeServices:
+    """Starts all fakes on local ports and tells which env variables point the bot at them"""
+    def __init__(
+        self,
+        mindsdb: FakeConfig = FakeConfig(),
+        fusion_brain: FakeConfig = FakeConfig(),
+        news: FakeConfig = FakeConfig(),
+        telegram: FakeConfig = FakeConfig(),
+        generation_s: float = 1.0,
+    ) -> None:
+        self.mindsdb = FakeMindsDb(mindsdb)
+        self.apps = {
+            "fusion_brain": create_fusion_brain_app(fusion_brain, generation_s),
+            "news": create_news_app(news),
+            "telegram": create_telegram_app(telegram),
+        }
+        self.urls: dict[str, str] = {}
+        self._runners: list[web.AppRunner] = []
+
+    async def start(self, host: str = "127.0.0.1") -> None:
+        await self.mindsdb.start(host)
+        for name, app in self.apps.items():
+            runner = web.AppRunner(app)
+            await runner.setup()
+            site = web.TCPSite(runner, host, 0)
+            await site.start()
+            port = runner.addresses[0][1]
+            self.urls[name] = f"http://{host}:{port}"
+            self._runners.append(runner)
+
+    async def close(self) -> None:
+        await self.mindsdb.close()
+        for runner in self._runners:
+            await runner.cleanup()
+
+    def env(self) -> dict[str, str]:
+        return {
+            "MINDS_DB_HOST": "127.0.0.1",
+            "MINDS_DB_PORT": str(self.mindsdb.port),
+            "FUSION_BRAIN_URL": self.urls["fusion_brain"],
+            "NEWS_URL": self.urls["news"] + "/",
+            "TG_API_URL": self.urls["telegram"],
+        }
+
+    def stats(self) -> dict:
+        return {
+            "mindsdb": {"queries": self.mindsdb.queries, "errors": self.mindsdb.errors},
+            "fusion_brain": self.apps["fusion_brain"]["stats"],
+            "telegram": self.apps["telegram"]["stats"],
+        }
+
+
+def add_fake_args(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument("--mindsdb-latency", type=float, default=0.5)
+    parser.add_argument("--mindsdb-error-rate", type=float, default=0.0)
+    parser.add_argument("--image-latency", type=float, default=0.05)
+    parser.add_argument("--image-error-rate", type=float, default=0.0)
+    parser.add_argument("--image-generation", type=float, default=3.0)
+    parser.add_argument("--tg-latency", type=float, default=0.05)
+    parser.add_argument("--tg-error-rate", type=float, default=0.0)
+
+
+def fakes_from_args(args: argparse.Namespace) -> FakeServices:
+    return FakeServices(
+        mindsdb=FakeConfig(args.mindsdb_latency, args.mindsdb_error_rate),
+        fusion_brain=FakeConfig(args.image_latency, args.image_error_rate),
+        telegram=FakeConfig(args.tg_latency, args.tg_error_rate),
+        generation_s=args.image_generation,
+    )
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    add_fake_args(parser)
+    fakes = fakes_from_args(parser.parse_args())
+    await fakes.start()
+    for key, value in fakes.env().items():
+        print(f'{key}="{value}"')
+    await asyncio.Event().wait()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(main())
@@ -0,0 +1,71 @@
+from collections import Counter
+from typing import NamedTuple
+import logging
+
+import aiohttp
+from yarl import URL
+
+
+logger = logging.getLogger("http_client")
+
+
+class HostConfig(NamedTuple):
+    limit: int = 10
+    keepalive_timeout_s: float = 30
+    dns_cache_ttl_s: int = 300
+
+
+class HttpClient:
+    """Application wide aiohttp sessions, one per origin, so connections are reused between requests"""
+    def __init__(self, hosts: dict[str, HostConfig] | None = None, default: HostConfig = HostConfig()) -> None:
+        self.hosts = hosts or {}
+        self.default = default
+        self.created: Counter[str] = Counter()
+        self.reused: Counter[str] = Counter()
+        self._sessions: dict[str, aiohttp.ClientSession] = {}
+
+    def session(self, url: str, headers: dict | None = None) -> aiohttp.ClientSession:
+        """Returns session for origin of `url`, `headers` are used when session is created"""
+        url = URL(url)
+        origin = str(url.origin())
+        session = self._sessions.get(origin)
+        if session is None or session.closed:
+            session = self._sessions[origin] = self._create_session(url.host, origin, headers)
+        return session
+
+    def _create_session(self, host: str, origin: str, headers: dict | None) -> aiohttp.ClientSession:
+        config = self.hosts.get(host, self.default)
+        connector = aiohttp.TCPConnector(
+            limit=config.limit,
+            limit_per_host=config.limit,
+            keepalive_timeout=config.keepalive_timeout_s,
+            use_dns_cache=True,
+            ttl_dns_cache=config.dns_cache_ttl_s,
+        )
+        trace = aiohttp.TraceConfig()
+
+        async def on_create(*_):
+            self.created[origin] += 1
+
+        async def on_reuse(*_):
+            self.reused[origin] += 1
+
+        trace.on_connection_create_end.append(on_create)
+        trace.on_connection_reuseconn.append(on_reuse)
+        logger.info(f"Creating session for {origin}: {config}")
+        return aiohttp.ClientSession(headers=headers, connector=connector, trace_configs=[trace])
+
+    async def close(self) -> None:
+        for session in self._sessions.values():
+            await session.close()
+        self._sessions.clear()
+
+    def stats(self) -> dict[str, dict]:
+        return {
+            origin: {
+                "created": self.created[origin],
+                "reused": self.reused[origin],
+                "reuse_ratio": self.reused[origin] / ((self.created[origin] + self.reused[origin]) or 1),
+            }
+            for origin in self.created | self.reused
+        }
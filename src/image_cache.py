@@ -0,0 +1,101 @@
+from collections import OrderedDict
+from pathlib import Path
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import tempfile
+
+from models import Prompt
+
+
+logger = logging.getLogger("image_cache")
+IMAGE_CACHE_DIR = os.getenv("IMAGE_CACHE_DIR", "image_cache")
+IMAGE_CACHE_MAX_BYTES = int(float(os.getenv("IMAGE_CACHE_MAX_MB", 512)) * 1024 * 1024)
+
+
+class ImageCache:
+    """Generated images stored on disk by hash of their prompt, least recently used are removed above `max_bytes`"""
+    def __init__(self, directory: str = IMAGE_CACHE_DIR, max_bytes: int = IMAGE_CACHE_MAX_BYTES) -> None:
+        self.directory = Path(directory)
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._index: OrderedDict[str, int] = OrderedDict()
+        self._load()
+
+    def _load(self) -> None:
+        self.directory.mkdir(parents=True, exist_ok=True)
+        files = sorted(self.directory.glob("*.png"), key=lambda path: path.stat().st_mtime)
+        for path in files:
+            size = path.stat().st_size
+            self._index[path.stem] = size
+            self.size += size
+        logger.info(f"Loaded {len(self._index)} cached images, {self.size} bytes")
+
+    @staticmethod
+    def key(prompt: Prompt) -> str:
+        normalized = [
+            " ".join(prompt.text.lower().split()),
+            " ".join(prompt.style.lower().split()),
+            *prompt.resolution,
+        ]
+        return hashlib.sha256(json.dumps(normalized, ensure_ascii=False).encode()).hexdigest()
+
+    def _path(self, key: str) -> Path:
+        return self.directory / f"{key}.png"
+
+    async def get(self, prompt: Prompt) -> bytes | None:
+        key = self.key(prompt)
+        if key not in self._index:
+            self.misses += 1
+            return None
+        try:
+            image = await asyncio.to_thread(self._read, key)
+        except FileNotFoundError:
+            self.size -= self._index.pop(key)
+            self.misses += 1
+            return None
+        self._index.move_to_end(key)
+        self.hits += 1
+        return image
+
+    async def set(self, prompt: Prompt, image: bytes) -> None:
+        key = self.key(prompt)
+        evicted = []
+        self.size -= self._index.pop(key, 0)
+        self._index[key] = len(image)
+        self.size += len(image)
+        while self.size > self.max_bytes and len(self._index) > 1:
+            old_key, old_size = self._index.popitem(last=False)
+            self.size -= old_size
+            self.evictions += 1
+            evicted.append(old_key)
+        await asyncio.to_thread(self._write, key, image, evicted)
+
+    def _read(self, key: str) -> bytes:
+        path = self._path(key)
+        image = path.read_bytes()
+        # modification time keeps LRU order between restarts
+        os.utime(path)
+        return image
+
+    def _write(self, key: str, image: bytes, evicted: list[str]) -> None:
+        fd, tmp_path = tempfile.mkstemp(suffix=".tmp", dir=self.directory)
+        with os.fdopen(fd, "wb") as f:
+            f.write(image)
+        os.replace(tmp_path, self._path(key))
+        for old_key in evicted:
+            self._path(old_key).unlink(missing_ok=True)
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "images": len(self._index),
+            "bytes": self.size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
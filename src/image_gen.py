@@ -1,11 +1,20 @@
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable, Hashable, Iterator
 import base64
 import asyncio
+import io
 import logging
+import math
 import os
+import re
+import time
 
 import aiohttp
 
 from models import Prompt, Resolution
+from http_client import HttpClient
+from polling import GenerationTimes
+from image_cache import ImageCache
 
 
 logger = logging.getLogger("image_gen")
@@ -14,6 +23,18 @@ PROXY_USER = os.getenv("PROXY_USER")
 PROXY_PASSWORD = os.getenv("PROXY_PASSWORD")
 # PROXY = f"https://{PROXY_USER}:{PROXY_PASSWORD}@{PROXY_IP_PORT}"
 PROXY = None
+FUSION_BRAIN_URL = os.getenv("FUSION_BRAIN_URL", "https://fusionbrain.ai")
+# max images of one request generated at once and time limit for each of them
+IMAGE_CONCURRENCY = int(os.getenv("IMAGE_CONCURRENCY", 3))
+IMAGE_TIMEOUT_S = float(os.getenv("IMAGE_TIMEOUT_S", 120))
+# how long to wait for image before giving up
+IMAGE_DEADLINE_S = float(os.getenv("IMAGE_DEADLINE_S", 100))
+# status checks of all pockets are aligned to this cadence
+POLL_TICK_S = float(os.getenv("POLL_TICK_S", 0.5))
+POLL_CONCURRENCY = int(os.getenv("POLL_CONCURRENCY", 10))
+# start of base64 image in entities response: {"result": [{"response": ["<base64>"]...
+RESPONSE_MARKER = re.compile(rb'"response"\s*:\s*\[\s*"')
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
 
 
 def create_headers():
@@ -29,15 +50,200 @@ class ImageGenerationError(Exception):
     ...
 
 
+async def read_base64_field(
+    content: aiohttp.StreamReader,
+    marker: re.Pattern = RESPONSE_MARKER,
+    chunk_size: int = DOWNLOAD_CHUNK_SIZE,
+) -> bytes:
+    """Decodes base64 string that follows `marker` in JSON stream chunk by chunk,
+    so neither whole response nor whole base64 string are kept in memory"""
+    buffer = io.BytesIO()
+    head = b""
+    pending = b""
+    found = False
+    async for chunk in content.iter_chunked(chunk_size):
+        if not found:
+            head += chunk
+            match = marker.search(head)
+            if match is None:
+                # keep enough to find marker split between chunks
+                head = head[-64:]
+                continue
+            found = True
+            chunk = head[match.end():]
+            head = b""
+
+        end = chunk.find(b'"')
+        # JSON may escape "/" as "\/"
+        data = pending + (chunk if end == -1 else chunk[:end]).replace(b"\\", b"")
+        cut = len(data) - len(data) % 4
+        buffer.write(base64.b64decode(data[:cut]))
+        pending = data[cut:]
+        if end != -1:
+            break
+
+    if not found:
+        raise ImageGenerationError("No image in response.")
+    if pending:
+        buffer.write(base64.b64decode(pending + b"=" * (-len(pending) % 4)))
+    # getvalue does not copy when buffer is not shared
+    return buffer.getvalue()
+
+
+@dataclass
+class Pocket:
+    pocket_id: str
+    session: aiohttp.ClientSession
+    keys: list[Hashable]
+    schedule: Iterator[float]
+    started_at: float
+    check_at: float
+    future: asyncio.Future = field(repr=False)
+
+
+class PocketPoller:
+    """One loop checking status of all outstanding pockets instead of a loop per pocket"""
+    def __init__(
+        self,
+        check_status: Callable[[aiohttp.ClientSession, str], Awaitable[bool]],
+        get_image_bytes: Callable[[aiohttp.ClientSession, str], Awaitable[bytes]],
+        generation_times: GenerationTimes,
+        tick_s: float = POLL_TICK_S,
+        concurrency: int = POLL_CONCURRENCY,
+    ) -> None:
+        self.check_status = check_status
+        self.get_image_bytes = get_image_bytes
+        self.generation_times = generation_times
+        self.tick_s = tick_s
+        self.concurrency = concurrency
+        self.checks = 0
+        self.wakeups = 0
+        self._pockets: dict[str, Pocket] = {}
+        self._wakeup = asyncio.Event()
+        self._task: asyncio.Task | None = None
+        self._fetches: set[asyncio.Task] = set()
+
+    def __len__(self) -> int:
+        return len(self._pockets)
+
+    def _align(self, moment: float) -> float:
+        return math.ceil(moment / self.tick_s) * self.tick_s
+
+    async def wait(
+        self,
+        session: aiohttp.ClientSession,
+        pocket_id: str,
+        keys: list[Hashable],
+        started_at: float,
+        deadline_s: float,
+    ) -> bytes:
+        schedule = self.generation_times.schedule(keys, deadline_s)
+        pocket = Pocket(
+            pocket_id, session, keys, schedule, started_at,
+            self._align(started_at + next(schedule)),
+            asyncio.get_running_loop().create_future(),
+        )
+        self._pockets[pocket_id] = pocket
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+        self._wakeup.set()
+        try:
+            return await pocket.future
+        finally:
+            self._pockets.pop(pocket_id, None)
+
+    async def _run(self) -> None:
+        semaphore = asyncio.Semaphore(self.concurrency)
+        while self._pockets:
+            now = time.monotonic()
+            due = [pocket for pocket in self._pockets.values() if pocket.check_at <= now]
+            if due:
+                self.wakeups += 1
+                await asyncio.gather(*[self._check(semaphore, pocket) for pocket in due])
+            if not self._pockets:
+                break
+
+            next_check_at = min(pocket.check_at for pocket in self._pockets.values())
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), max(next_check_at - time.monotonic(), 0))
+            except asyncio.TimeoutError:
+                pass
+
+    async def _check(self, semaphore: asyncio.Semaphore, pocket: Pocket) -> None:
+        if pocket.future.done():
+            self._pockets.pop(pocket.pocket_id, None)
+            return
+        self.checks += 1
+        try:
+            async with semaphore:
+                ready = await self.check_status(pocket.session, pocket.pocket_id)
+        except Exception as e:
+            self._finish(pocket, error=e)
+            return
+
+        if ready:
+            self.generation_times.add(pocket.keys, time.monotonic() - pocket.started_at)
+            self._pockets.pop(pocket.pocket_id, None)
+            # fetching image must not delay checks of other pockets
+            task = asyncio.create_task(self._fetch(pocket))
+            self._fetches.add(task)
+            task.add_done_callback(self._fetches.discard)
+            return
+
+        delay = next(pocket.schedule, None)
+        if delay is None:
+            self._finish(pocket, error=ImageGenerationError("Server is not responding."))
+            return
+        pocket.check_at = self._align(pocket.check_at + delay)
+
+    async def _fetch(self, pocket: Pocket) -> None:
+        try:
+            image_bytes = await self.get_image_bytes(pocket.session, pocket.pocket_id)
+        except Exception as e:
+            self._finish(pocket, error=e)
+        else:
+            self._finish(pocket, result=image_bytes)
+
+    def _finish(self, pocket: Pocket, result: bytes | None = None, error: Exception | None = None) -> None:
+        self._pockets.pop(pocket.pocket_id, None)
+        if pocket.future.done():
+            return
+        if error is not None:
+            pocket.future.set_exception(error)
+        else:
+            pocket.future.set_result(result)
+
+    def stats(self) -> dict[str, int]:
+        return {"pockets": len(self._pockets), "checks": self.checks, "wakeups": self.wakeups}
+
+
 class ImageGenerator:
-    REQUEST_STATUS_DELAY_S = 2
-    MAX_RETRIES = 50
-    RUN_URL = "https://fusionbrain.ai/api/v1/text2image/run"
-    STATUS_URL = "https://fusionbrain.ai/api/v1/text2image/inpainting/pockets/{pocket_id}/status"
-    ENTITIES_URL = "https://fusionbrain.ai/api/v1/text2image/inpainting/pockets/{pocket_id}/entities"
+    DEFAULT_GENERATION_S = 20
+    MIN_STATUS_DELAY_S = 0.5
+    MAX_STATUS_DELAY_S = 8
+    RUN_URL = f"{FUSION_BRAIN_URL}/api/v1/text2image/run"
+    STATUS_URL = f"{FUSION_BRAIN_URL}/api/v1/text2image/inpainting/pockets/{{pocket_id}}/status"
+    ENTITIES_URL = f"{FUSION_BRAIN_URL}/api/v1/text2image/inpainting/pockets/{{pocket_id}}/entities"
 
-    def __init__(self) -> None:
+    def __init__(
+        self, 
+        http_client: HttpClient, 
+        concurrency: int = IMAGE_CONCURRENCY, 
+        timeout_s: float = IMAGE_TIMEOUT_S,
+        deadline_s: float = IMAGE_DEADLINE_S,
+        image_cache: ImageCache | None = None,
+    ) -> None:
+        self.http_client = http_client
+        self.image_cache = image_cache
         self.headers = create_headers()
+        self.concurrency = concurrency
+        self.timeout_s = timeout_s
+        self.deadline_s = deadline_s
+        self.generation_times = GenerationTimes(
+            self.DEFAULT_GENERATION_S, self.MIN_STATUS_DELAY_S, self.MAX_STATUS_DELAY_S
+        )
+        self.poller = PocketPoller(self._check_status, self._get_image_bytes, self.generation_times)
 
     @staticmethod
     async def _process_response(response: aiohttp.ClientResponse, required_code: int = 200):
@@ -76,8 +282,7 @@ class ImageGenerator:
             await self._process_response(response)
             data = await response.json()
             status_str = data["result"]
-            logger.info(
-                f"WAITING: status = {status_str}, delay = {self.REQUEST_STATUS_DELAY_S} s")
+            logger.info(f"WAITING: status = {status_str}")
             return status_str == "SUCCESS"
 
     async def _get_image_bytes(self, session: aiohttp.ClientSession, pocket_id: str) -> bytes:
@@ -87,9 +292,7 @@ class ImageGenerator:
             # proxy=PROXY
         ) as response:
             await self._process_response(response)
-            data = await response.json()
-            image_bytes = data["result"][0]["response"][0]
-            image_bytes = base64.b64decode(image_bytes)
+            image_bytes = await read_base64_field(response.content)
             logger.info("Got image bytes")
             return image_bytes
 
@@ -98,31 +301,59 @@ class ImageGenerator:
         session: aiohttp.ClientSession,
         prompt: Prompt,
     ) -> bytes:
+        start = time.monotonic()
         pocket_id = await self._get_pocket_id(session, prompt)
-        status = await self._check_status(session, pocket_id)
-        retries = 0
-        while not status and retries <= self.MAX_RETRIES:
-            await asyncio.sleep(self.REQUEST_STATUS_DELAY_S)
-            retries += 1
-            status = await self._check_status(session, pocket_id)
-        if not status or retries > self.MAX_RETRIES:
-            raise ImageGenerationError("Server is not responding.")
-        image_bytes = await self._get_image_bytes(session, pocket_id)
+        keys = [(prompt.resolution, prompt.style), prompt.resolution, None]
+        return await self.poller.wait(session, pocket_id, keys, start, self.deadline_s)
+
+    async def _get_image_with_timeout(
+        self,
+        session: aiohttp.ClientSession,
+        semaphore: asyncio.Semaphore,
+        prompt: Prompt,
+        force_new: bool = False,
+    ) -> bytes:
+        if self.image_cache is not None and not force_new:
+            image_bytes = await self.image_cache.get(prompt)
+            if image_bytes is not None:
+                logger.info(f"Got cached image for {prompt.description}")
+                return image_bytes
+
+        async with semaphore:
+            try:
+                image_bytes = await asyncio.wait_for(self._get_image(session, prompt), self.timeout_s)
+            except asyncio.TimeoutError:
+                raise ImageGenerationError("Server is not responding.")
+
+        if self.image_cache is not None:
+            await self.image_cache.set(prompt, image_bytes)
         return image_bytes
 
-    async def get_images(self, prompts: list[Prompt]) -> list[bytes]:
-        images = []
-        async with aiohttp.ClientSession(headers=self.headers) as session:
-            for prompt in prompts:
-                image_bytes = await self._get_image(session, prompt)
-                images.append(image_bytes)
+    async def get_images(self, prompts: list[Prompt], force_new: bool = False) -> list[bytes]:
+        """Generates images concurrently, returns the ones that succeeded and fails only if all of them failed.
+        Images of the same prompts are taken from cache, unless `force_new` is set"""
+        semaphore = asyncio.Semaphore(self.concurrency)
+        session = self.http_client.session(self.RUN_URL, self.headers)
+        results = await asyncio.gather(
+            *[self._get_image_with_timeout(session, semaphore, prompt, force_new) for prompt in prompts],
+            return_exceptions=True
+        )
+
+        images = [result for result in results if isinstance(result, bytes)]
+        errors = [result for result in results if isinstance(result, BaseException)]
+        for error in errors:
+            logger.error(f"Image generation failed: {error!r}")
+        if errors and not images:
+            raise errors[0]
         return images
 
 
 async def main():
-    image_gen = ImageGenerator()
+    http_client = HttpClient()
+    image_gen = ImageGenerator(http_client)
     logging.basicConfig(level=logging.INFO)
-    async with aiohttp.ClientSession(headers=image_gen.headers) as session:
+    session = http_client.session(image_gen.RUN_URL, image_gen.headers)
+    try:
         prompt = "милая девушка татарка с узкими зелеными глазами и широким лицом, маленьким носиком, глазами с макияжем, оранжевые светлые волосы, с букетом азалии в руках"
         image_bytes = await image_gen._get_image(
             session, Prompt(
@@ -133,6 +364,8 @@ async def main():
         )
         with open(f"pics/{prompt}.png", "wb") as f:
             f.write(image_bytes)
+    finally:
+        await http_client.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,166 @@
+from collections import OrderedDict, deque
+from dataclasses import dataclass, field
+import asyncio
+import logging
+import os
+import time
+
+from image_gen import ImageGenerator
+from models import Prompt
+
+
+logger = logging.getLogger("image_queue")
+IMAGE_WORKERS = int(os.getenv("IMAGE_WORKERS", 4))
+USER_PRIORITY = 0
+# scheduled posts are generated ahead of time, so by default users go first
+POST_PRIORITY = int(os.getenv("POST_IMAGE_PRIORITY", -1))
+# waiting jobs gain one priority level every this many seconds, so low priority jobs aren't starved
+PRIORITY_AGING_S = float(os.getenv("IMAGE_PRIORITY_AGING_S", 60))
+POST_USER_ID = 0
+
+
+@dataclass
+class ImageJob:
+    user_id: int
+    prompts: list[Prompt]
+    force_new: bool = False
+    priority: int = USER_PRIORITY
+    submitted_at: float = field(default_factory=time.monotonic)
+    started: asyncio.Event = field(default_factory=asyncio.Event, repr=False)
+    future: asyncio.Future = field(default_factory=lambda: asyncio.get_running_loop().create_future(), repr=False)
+
+
+class ImageJobQueue:
+    """Image generation jobs run by a limited number of workers.
+
+    Jobs with higher priority go first, users with the same priority take turns,
+    so one user can't occupy all workers. Priority of a level grows with the waiting time
+    of its oldest job, so lower levels get their turn too.
+    """
+    def __init__(
+        self,
+        image_gen: ImageGenerator,
+        workers: int = IMAGE_WORKERS,
+        aging_s: float = PRIORITY_AGING_S,
+    ) -> None:
+        self.image_gen = image_gen
+        self.workers = workers
+        self.aging_s = aging_s
+        self.done = 0
+        self.failed = 0
+        self._levels: dict[int, OrderedDict[int, deque[ImageJob]]] = {}
+        self._queued = asyncio.Semaphore(0)
+        self._taken = asyncio.Event()
+        self._tasks: list[asyncio.Task] = []
+
+    def __len__(self) -> int:
+        return sum(len(jobs) for level in self._levels.values() for jobs in level.values())
+
+    def start(self) -> None:
+        self._tasks = [asyncio.create_task(self._work()) for _ in range(self.workers)]
+
+    async def close(self) -> None:
+        """Stops workers, running and queued jobs are cancelled"""
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        for level in self._levels.values():
+            for jobs in level.values():
+                for job in jobs:
+                    job.future.cancel()
+                    # so nobody waits for a job which will never start
+                    job.started.set()
+        self._levels.clear()
+        self._notify_taken()
+
+    def submit(
+        self,
+        user_id: int,
+        prompts: list[Prompt],
+        force_new: bool = False,
+        priority: int = USER_PRIORITY,
+    ) -> ImageJob:
+        job = ImageJob(user_id, prompts, force_new, priority)
+        level = self._levels.setdefault(priority, OrderedDict())
+        level.setdefault(user_id, deque()).append(job)
+        self._queued.release()
+        return job
+
+    async def get_images(self, user_id: int, prompts: list[Prompt], priority: int = USER_PRIORITY) -> list[bytes]:
+        return await self.submit(user_id, prompts, priority=priority).future
+
+    def position(self, job: ImageJob) -> int:
+        """Number of queued jobs that will start before `job` without aging, -1 if it is not queued"""
+        level = self._levels.get(job.priority, {})
+        jobs = level.get(job.user_id, [])
+        if job not in jobs:
+            return -1
+
+        position = sum(
+            len(user_jobs)
+            for priority, other_level in self._levels.items() if priority > job.priority
+            for user_jobs in other_level.values()
+        )
+        # every user before this one gets one more turn in the current round
+        index = list(jobs).index(job)
+        before = True
+        for user_id, user_jobs in level.items():
+            if user_id == job.user_id:
+                before = False
+                position += index
+                continue
+            position += min(len(user_jobs), index + before)
+        return position
+
+    async def wait_taken(self) -> None:
+        """Waits until a worker takes next job, so positions of queued jobs change"""
+        await self._taken.wait()
+
+    def _notify_taken(self) -> None:
+        self._taken.set()
+        self._taken = asyncio.Event()
+
+    def _level_priority(self, priority: int, level: OrderedDict[int, deque[ImageJob]], now: float) -> float:
+        oldest = min(jobs[0].submitted_at for jobs in level.values())
+        return priority + (now - oldest) / self.aging_s
+
+    def _next_job(self) -> ImageJob:
+        now = time.monotonic()
+        priority = max(
+            (priority for priority, level in self._levels.items() if level),
+            key=lambda priority: self._level_priority(priority, self._levels[priority], now),
+        )
+        level = self._levels[priority]
+        user_id, jobs = next(iter(level.items()))
+        job = jobs.popleft()
+        if jobs:
+            level.move_to_end(user_id)
+        else:
+            del level[user_id]
+        self._notify_taken()
+        return job
+
+    async def _work(self) -> None:
+        while True:
+            await self._queued.acquire()
+            job = self._next_job()
+            if job.future.done():
+                continue
+            job.started.set()
+            try:
+                images = await self.image_gen.get_images(job.prompts, job.force_new)
+            except asyncio.CancelledError:
+                job.future.cancel()
+                raise
+            except Exception as e:
+                self.failed += 1
+                logger.warning(f"Image job of {job.user_id} failed: {e!r}")
+                if not job.future.done():
+                    job.future.set_exception(e)
+            else:
+                self.done += 1
+                if not job.future.done():
+                    job.future.set_result(images)
+
+    def stats(self) -> dict[str, int]:
+        return {"queued": len(self), "done": self.done, "failed": self.failed}
@@ -0,0 +1,59 @@
+from typing import TYPE_CHECKING
+import asyncio
+import logging
+import random
+
+from mongo import InspirationsDb
+
+if TYPE_CHECKING:
+    from async_model import AsyncMotyaModel
+
+
+logger = logging.getLogger("inspirations")
+
+
+class InspirationPool:
+    """Inspirations for posts generated ahead of time, so new post needs only one model call"""
+    def __init__(self, model: "AsyncMotyaModel", db: InspirationsDb, low_watermark: int = 5) -> None:
+        self.model = model
+        self.db = db
+        self.low_watermark = low_watermark
+        self.sizes: dict[str, int] = {}
+        self._refilling: dict[str, asyncio.Task] = {}
+
+    async def fill(self, themes: list[str]) -> None:
+        self.sizes = await self.db.count_inspirations()
+        await asyncio.gather(*[
+            self.refill(theme) for theme in themes
+            if self.sizes.get(theme, 0) < self.low_watermark
+        ])
+
+    async def draw(self, themes: list[str]) -> str:
+        theme = random.choice(themes)
+        inspiration = await self.db.pop_inspiration(theme)
+        self.sizes[theme] = max(self.sizes.get(theme, 1) - 1, 0)
+        if self.sizes[theme] < self.low_watermark:
+            self.refill_soon(theme)
+
+        if inspiration is None:
+            logger.info(f"No inspirations stored for {theme}, asking model")
+            inspiration = random.choice(await self.model.get_inspirations(theme))
+        return inspiration.strip()
+
+    def refill_soon(self, theme: str) -> None:
+        if theme in self._refilling:
+            return
+        task = asyncio.create_task(self.refill(theme))
+        self._refilling[theme] = task
+        task.add_done_callback(lambda _: self._refilling.pop(theme, None))
+
+    async def refill(self, theme: str) -> None:
+        try:
+            inspirations = await self.model.get_inspirations(theme)
+        except Exception as e:
+            logger.error(f"Refilling inspirations for {theme} failed: {e}")
+            return
+        inspirations = [insp.strip() for insp in inspirations if insp.strip()]
+        await self.db.add_inspirations(theme, inspirations)
+        self.sizes[theme] = self.sizes.get(theme, 0) + len(inspirations)
+        logger.info(f"Added {len(inspirations)} inspirations for {theme}")
@@ -0,0 +1,153 @@
+"""Pushes synthetic updates through the real dispatcher against local fakes.
+
+Mongo is not faked: MONGO_URL must point to a local instance, e.g. `docker run -p 27017:27017 mongo`.
+Example: python load_test.py --updates 500 --concurrency 50 --mix message=0.8,draw=0.2
+"""
+from collections import Counter, defaultdict
+import argparse
+import asyncio
+import logging
+import os
+import random
+import time
+
+from dotenv import load_dotenv
+
+from fakes import add_fake_args, fakes_from_args
+
+
+FAKE_TOKEN = "123456789:AAHfakefakefakefakefakefakefakefake"
+UPDATE_TEXTS = {
+    "message": ["мотя, как дела?", "расскажи сказку", "что ты любишь есть?"],
+    "draw": ["/draw котик", "/draw тушканчик в космосе -s акварель", "/draw лес -r 1024 768"],
+    "start": ["/start"],
+}
+
+
+def make_update(update_id: int, user_id: int, text: str) -> dict:
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"},
+            "text": text,
+        },
+    }
+
+
+def parse_mix(mix: str) -> dict[str, float]:
+    weights = {}
+    for item in mix.split(","):
+        kind, weight = item.split("=")
+        if kind not in UPDATE_TEXTS:
+            raise ValueError(f"Unknown update kind: {kind}")
+        weights[kind] = float(weight)
+    return weights
+
+
+def percentile(values: list[float], q: float) -> float:
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+class LoadReport:
+    def __init__(self) -> None:
+        self.latencies: dict[str, list[float]] = defaultdict(list)
+        self.errors: Counter[str] = Counter()
+        self.elapsed_s = 0.0
+
+    def print(self, services: dict) -> None:
+        total = sum(len(latencies) for latencies in self.latencies.values())
+        print(f"\n{total} updates in {self.elapsed_s:.2f} s, {total / self.elapsed_s:.1f} updates/s")
+        print(f"{'kind':<10}{'count':>8}{'errors':>8}{'p50, s':>10}{'p95, s':>10}{'p99, s':>10}")
+        for kind, latencies in sorted(self.latencies.items()):
+            print(
+                f"{kind:<10}{len(latencies):>8}{self.errors[kind]:>8}"
+                f"{percentile(latencies, 0.5):>10.3f}{percentile(latencies, 0.95):>10.3f}"
+                f"{percentile(latencies, 0.99):>10.3f}"
+            )
+        print(f"error rate: {sum(self.errors.values()) / total:.2%}" if total else "")
+        print(f"backend calls: {services}")
+
+
+async def run_load(args: argparse.Namespace) -> LoadReport:
+    fakes = fakes_from_args(args)
+    await fakes.start()
+    load_dotenv()
+    os.environ.update(fakes.env())
+    os.environ.setdefault("TG_TOKEN", FAKE_TOKEN)
+    os.environ.setdefault("ADMIN_ID", "1")
+    os.environ.setdefault("SCHEDULED_POSTS", "0")
+
+    # bot reads env at import time, so it must be imported after fakes are started
+    from aiogram import Bot, Dispatcher, types
+    from bot import dp, on_startup, on_shutdown, image_deliveries
+
+    Bot.set_current(dp.bot)
+    Dispatcher.set_current(dp)
+    await on_startup(dp)
+
+    weights = parse_mix(args.mix)
+    report = LoadReport()
+    semaphore = asyncio.Semaphore(args.concurrency)
+    kinds: dict[int, str] = {}
+
+    async def count_error(update: types.Update, error: Exception) -> None:
+        """Errors handlers reply to user instead of raising, so errors are counted before them"""
+        report.errors[kinds[update.update_id]] += 1
+        logging.debug(f"Update {update.update_id} failed: {error!r}")
+
+    dp.errors_handlers.register(count_error, index=0)
+
+    async def process(update_id: int) -> None:
+        kind = kinds[update_id] = random.choices(list(weights), list(weights.values()))[0]
+        user_id = 1000 + update_id % args.users
+        update = types.Update.to_object(make_update(update_id, user_id, random.choice(UPDATE_TEXTS[kind])))
+        async with semaphore:
+            start = time.perf_counter()
+            try:
+                await dp.process_update(update)
+            except Exception:
+                # already counted by count_error
+                pass
+            report.latencies[kind].append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    tasks = []
+    for update_id in range(1, args.updates + 1):
+        tasks.append(asyncio.create_task(process(update_id)))
+        if args.rate:
+            await asyncio.sleep(1 / args.rate)
+    await asyncio.gather(*tasks)
+    # images are sent after handlers return, their errors must be counted too
+    while image_deliveries:
+        await asyncio.wait(image_deliveries)
+    report.elapsed_s = time.perf_counter() - start
+
+    report.print(fakes.stats())
+    await on_shutdown(dp)
+    await dp.storage.close()
+    await dp.bot.session.close()
+    await fakes.close()
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--updates", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=20, help="max updates processed at once")
+    parser.add_argument("--rate", type=float, default=0, help="updates per second, 0 to send all at once")
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--mix", default="message=0.7,draw=0.2,start=0.1")
+    add_fake_args(parser)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+    asyncio.run(run_load(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,17 +1,57 @@
 import logging
 
-from aiogram import executor
+from aiogram import executor, types, Bot, Dispatcher
+from aiohttp import web
 from dotenv import load_dotenv
 
 
+def run_webhook(dp: Dispatcher, on_startup, on_shutdown):
+    from webhook import WebhookServer, WEBHOOK_HOST, WEBHOOK_PORT, WEBHOOK_PATH, WEBHOOK_URL, WEBHOOK_SECRET, \
+        WEBHOOK_MAX_UPDATES
+
+    async def process_update(data: dict):
+        Bot.set_current(dp.bot)
+        Dispatcher.set_current(dp)
+        await dp.process_update(types.Update(**data))
+
+    server = WebhookServer(process_update)
+    app = server.create_app(WEBHOOK_PATH)
+
+    async def startup(_):
+        await on_startup(dp)
+        await dp.bot.set_webhook(
+            WEBHOOK_URL + WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET,
+            max_connections=WEBHOOK_MAX_UPDATES,
+        )
+
+    async def shutdown(_):
+        # webhook isn't deleted, other replicas keep receiving updates
+        await server.drain()
+        logging.info(f"Webhook updates: {server.stats()}")
+        await on_shutdown(dp)
+        await dp.storage.close()
+        await dp.storage.wait_closed()
+        await (await dp.bot.get_session()).close()
+
+    app.on_startup.append(startup)
+    app.on_shutdown.append(shutdown)
+    web.run_app(app, host=WEBHOOK_HOST, port=WEBHOOK_PORT)
+
+
 if __name__ == "__main__":
     load_dotenv()
     logging.basicConfig(level=logging.INFO)
 
-    from bot import dp, on_startup
+    from bot import dp, on_startup, on_shutdown
+    from webhook import WEBHOOK_URL
 
-    executor.start_polling(
-        dispatcher=dp,
-        on_startup=on_startup,
-        skip_updates=True
-    )
+    if WEBHOOK_URL:
+        run_webhook(dp, on_startup, on_shutdown)
+    else:
+        executor.start_polling(
+            dispatcher=dp,
+            on_startup=on_startup,
+            on_shutdown=on_shutdown,
+            skip_updates=True
+        )
@@ -0,0 +1,143 @@
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, NamedTuple
+import asyncio
+import logging
+import os
+import time
+
+import aiomysql
+
+
+logger = logging.getLogger("mindsdb_pool")
+
+
+class PoolConfig(NamedTuple):
+    host: str = "cloud.mindsdb.com"
+    port: int = 3306
+    minsize: int = 1
+    maxsize: int = 10
+    # seconds after which connection is reopened, -1 to keep forever
+    recycle: int = -1
+    # connections opened and checked at startup
+    warmup: int = 0
+    # connections idle longer than this are pinged before use, 0 to disable
+    ping_after_s: float = 0
+
+    @classmethod
+    def from_env(cls) -> "PoolConfig":
+        default = cls()
+        return cls(
+            host=os.getenv("MINDS_DB_HOST", default.host),
+            port=int(os.getenv("MINDS_DB_PORT", default.port)),
+            minsize=int(os.getenv("MINDS_DB_POOL_MIN", default.minsize)),
+            maxsize=int(os.getenv("MINDS_DB_POOL_MAX", default.maxsize)),
+            recycle=int(os.getenv("MINDS_DB_POOL_RECYCLE_S", default.recycle)),
+            warmup=int(os.getenv("MINDS_DB_POOL_WARMUP", default.warmup)),
+            ping_after_s=float(os.getenv("MINDS_DB_POOL_PING_AFTER_S", default.ping_after_s)),
+        )
+
+
+class MindsDbPool:
+    """aiomysql pool with per-model concurrency limits, health checks and wait time metrics"""
+    def __init__(
+        self,
+        pool: aiomysql.Pool,
+        config: PoolConfig,
+        model_limits: dict[str, int] | None = None,
+    ) -> None:
+        self.pool = pool
+        self.config = config
+        self.limits = {
+            model_name: asyncio.Semaphore(limit)
+            for model_name, limit in (model_limits or {}).items()
+        }
+        self.in_use: dict[str, int] = {}
+        self.acquired = 0
+        self.pings = 0
+        self.wait_total_s = 0.0
+        self.wait_max_s = 0.0
+
+    @classmethod
+    async def create(
+        cls,
+        user: str | None,
+        password: str | None,
+        config: PoolConfig | None = None,
+        model_limits: dict[str, int] | None = None,
+    ) -> "MindsDbPool":
+        config = config or PoolConfig.from_env()
+        pool = await aiomysql.create_pool(
+            host=config.host,
+            port=config.port,
+            user=user,
+            password=password,
+            minsize=config.minsize,
+            maxsize=config.maxsize,
+            pool_recycle=config.recycle,
+        )
+        instance = cls(pool, config, model_limits)
+        await instance.warmup(config.warmup)
+        return instance
+
+    async def warmup(self, amount: int) -> None:
+        amount = min(amount, self.config.maxsize)
+        if amount <= 0:
+            return
+        connections = await asyncio.gather(*[self.pool.acquire() for _ in range(amount)])
+        try:
+            await asyncio.gather(*[conn.ping(reconnect=True) for conn in connections])
+        finally:
+            for conn in connections:
+                self.pool.release(conn)
+        logger.info(f"Warmed up {amount} connections to {self.config.host}")
+
+    @asynccontextmanager
+    async def acquire(self, model_name: str | None = None) -> AsyncIterator[aiomysql.Connection]:
+        semaphore = self.limits.get(model_name)
+        start = time.monotonic()
+        if semaphore is not None:
+            await semaphore.acquire()
+        try:
+            async with self.pool.acquire() as conn:
+                self._record_wait(time.monotonic() - start)
+                await self._check_alive(conn)
+                self.in_use[model_name] = self.in_use.get(model_name, 0) + 1
+                try:
+                    yield conn
+                finally:
+                    self.in_use[model_name] -= 1
+        finally:
+            if semaphore is not None:
+                semaphore.release()
+
+    def _record_wait(self, wait_s: float) -> None:
+        self.acquired += 1
+        self.wait_total_s += wait_s
+        self.wait_max_s = max(self.wait_max_s, wait_s)
+
+    async def _check_alive(self, conn: aiomysql.Connection) -> None:
+        if not self.config.ping_after_s:
+            return
+        idle_s = asyncio.get_running_loop().time() - conn.last_usage
+        if idle_s >= self.config.ping_after_s:
+            self.pings += 1
+            await conn.ping(reconnect=True)
+
+    def stats(self) -> dict:
+        busy = self.pool.size - self.pool.freesize
+        return {
+            "size": self.pool.size,
+            "free": self.pool.freesize,
+            "utilization": busy / self.pool.maxsize,
+            "in_use": dict(self.in_use),
+            "acquired": self.acquired,
+            "pings": self.pings,
+            "wait_avg_s": self.wait_total_s / self.acquired if self.acquired else 0,
+            "wait_max_s": self.wait_max_s,
+        }
+
+    def close(self) -> None:
+        self.pool.close()
+
+    async def wait_closed(self) -> None:
+        await self.pool.wait_closed()
@@ -1,5 +1,7 @@
 from typing import NamedTuple
 from dataclasses import dataclass
+from collections import deque
+from itertools import islice
 
 DEFAULT_SIZE = 768
 
@@ -37,16 +39,43 @@ class UserConfig(NamedTuple):
     last_image: str = ""
 
 
-class CappedList(list):
+class CappedList(deque):
+    """Chat history that keeps serialized length of every message to cut dialog without rebuilding it"""
     def __init__(self, messages: list[str] = None, max_store: int = 5):
-        super().__init__()
-        self.max_store = max_store
+        super().__init__(maxlen=max_store)
+        self.lengths: deque[int] = deque(maxlen=max_store)
+        self.size = 0
 
-        messages = messages if messages is None else []
+        messages = messages if messages is not None else []
         for msg in messages:
             self.add_message(msg)
 
+    @property
+    def max_store(self) -> int:
+        return self.maxlen
+
+    @staticmethod
+    def serialize(message: str) -> str:
+        return f"-{message}"
+
     def add_message(self, message: str):
-        if len(self) >= self.max_store:
-            self.pop(0)
+        if len(self) == self.maxlen:
+            self.size -= self.lengths[0]
+        # +1 for a new line separator
+        length = len(self.serialize(message)) + 1
         self.append(message)
+        self.lengths.append(length)
+        self.size += length
+
+    def dialog(self, max_length: int) -> str:
+        """Returns longest suffix of history which serialized length is less than `max_length`"""
+        if self.size - 1 < max_length:
+            return "\n".join(self.serialize(msg) for msg in self)
+
+        size, amount = 0, 0
+        for length in reversed(self.lengths):
+            if size + length - 1 >= max_length:
+                break
+            size += length
+            amount += 1
+        return "\n".join(self.serialize(msg) for msg in islice(self, len(self) - amount, None))
@@ -1,100 +1,372 @@
+from datetime import datetime
+import asyncio
+import logging
+import os
+
+from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorGridFSBucket
+from pymongo import ReturnDocument, UpdateOne, WriteConcern
+from pymongo.errors import OperationFailure, PyMongoError
 import pymongo
 
-from models import UserConfig, Resolution
+from cache import TTLCache
+from models import UserConfig, Resolution, Post, CappedList
+
+
+logger = logging.getLogger("mongo")
+MONGO_MAX_POOL_SIZE = int(os.getenv("MONGO_MAX_POOL_SIZE", 50))
+MONGO_MIN_POOL_SIZE = int(os.getenv("MONGO_MIN_POOL_SIZE", 2))
+MONGO_MAX_IDLE_TIME_MS = int(os.getenv("MONGO_MAX_IDLE_TIME_MS", 5 * 60 * 1000))
+MONGO_TIMEOUT_MS = int(os.getenv("MONGO_TIMEOUT_MS", 5000))
+CONFIG_POLL_INTERVAL_S = float(os.getenv("CONFIG_POLL_INTERVAL_S", 10))
+USER_CONFIG_CACHE_SIZE = int(os.getenv("USER_CONFIG_CACHE_SIZE", 1024))
+USER_CONFIG_CACHE_TTL_S = float(os.getenv("USER_CONFIG_CACHE_TTL_S", 30))
+USER_CONFIG_FLUSH_INTERVAL_S = float(os.getenv("USER_CONFIG_FLUSH_INTERVAL_S", 5))
+# news history is kept forever when retention is 0
+NEWS_RETENTION_DAYS = float(os.getenv("NEWS_RETENTION_DAYS", 0))
+# server is not a replica set
+CHANGE_STREAMS_UNSUPPORTED = 40573
+
+_clients: dict[str, AsyncIOMotorClient] = {}
+
+
+def get_client(url: str) -> AsyncIOMotorClient:
+    """One client per url, so all collections share its connection pool"""
+    client = _clients.get(url)
+    if client is None:
+        client = _clients[url] = AsyncIOMotorClient(
+            url,
+            maxPoolSize=MONGO_MAX_POOL_SIZE,
+            minPoolSize=MONGO_MIN_POOL_SIZE,
+            maxIdleTimeMS=MONGO_MAX_IDLE_TIME_MS,
+            serverSelectionTimeoutMS=MONGO_TIMEOUT_MS,
+            connectTimeoutMS=MONGO_TIMEOUT_MS,
+        )
+    return client
+
+
+def close_clients() -> None:
+    for client in _clients.values():
+        client.close()
+    _clients.clear()
 
 
 class MongoDatabase:
     def __init__(self, url, db_name, collection_name):
-        self.client = pymongo.MongoClient(url)[db_name][collection_name]
+        self.client = get_client(url)[db_name][collection_name]
 
-    def get_all(self) -> list:
-        return [r for r in self.client.find()]
+    async def get_all(self) -> list:
+        return await self.client.find().to_list(None)
 
-    def count(self) -> int:
-        return self.client.count_documents({})
+    async def count(self) -> int:
+        return await self.client.count_documents({})
 
 
 class BotConfigDb(MongoDatabase):
-    def get_themes(self) -> None | list[str]:
-        result = self.client.find_one({"_id": "themes"}) or {}
-        return result.get("themes")
-
-    def add_themes(self, themes: list[str]) -> None:
-        self.client.update_one(
-            {"_id": "themes"},
-            {"$addToSet": {"themes": {"$each": themes}}}
-        )
+    """Config documents are kept in memory, they are updated by change stream
+    or by polling if change streams aren't supported by the server"""
+    def __init__(self, url, db_name, collection_name):
+        super().__init__(url, db_name, collection_name)
+        self._documents: dict[str, dict] | None = None
+
+    async def load(self) -> None:
+        self._documents = {document["_id"]: document for document in await self.get_all()}
+        logger.debug(f"Loaded config documents: {list(self._documents)}")
 
-    def get_image_styles(self) -> None | list[str]:
-        result = self.client.find_one({"_id": "styles"}) or {}
-        return result.get("styles")
+    async def watch(self, poll_interval_s: float = CONFIG_POLL_INTERVAL_S) -> None:
+        while True:
+            try:
+                async with self.client.watch(full_document="updateLookup") as stream:
+                    await self.load()
+                    async for change in stream:
+                        self._apply_change(change)
+            except PyMongoError as e:
+                if isinstance(e, OperationFailure) and e.code == CHANGE_STREAMS_UNSUPPORTED:
+                    logger.warning(f"Change streams are unavailable, polling config every {poll_interval_s} s")
+                    break
+                logger.error(f"Config change stream failed: {e}")
+                await asyncio.sleep(poll_interval_s)
 
-    def add_image_styles(self, styles: list[str]) -> None:
-        self.client.update_one(
-            {"_id": "styles"},
-            {"$addToSet": {"styles": {"$each": styles}}}
+        while True:
+            await asyncio.sleep(poll_interval_s)
+            try:
+                await self.load()
+            except PyMongoError as e:
+                logger.error(f"Reloading config failed: {e}")
+
+    def _apply_change(self, change: dict) -> None:
+        operation = change["operationType"]
+        if operation in ("insert", "update", "replace") and change.get("fullDocument"):
+            self._documents[change["documentKey"]["_id"]] = change["fullDocument"]
+        elif operation == "delete":
+            self._documents.pop(change["documentKey"]["_id"], None)
+
+    async def _get(self, _id: str) -> dict:
+        if self._documents is None:
+            await self.load()
+        return self._documents.get(_id, {})
+
+    async def _update(self, _id: str, update: dict, upsert: bool = False) -> None:
+        """Updates document and its local copy, so changes are visible before change stream sees them"""
+        document = await self.client.find_one_and_update(
+            {"_id": _id}, update, upsert=upsert, return_document=ReturnDocument.AFTER
         )
+        if self._documents is not None and document is not None:
+            self._documents[_id] = document
+
+    async def get_themes(self) -> None | list[str]:
+        return (await self._get("themes")).get("themes")
 
-    def get_main_prompt(self) -> None | str:
-        result = self.client.find_one({"_id": "main_prompt"}) or {}
-        return result.get("prompt")
+    async def add_themes(self, themes: list[str]) -> None:
+        await self._update("themes", {"$addToSet": {"themes": {"$each": themes}}})
 
-    def get_helper_prompt(self) -> None | str:
-        result = self.client.find_one({"_id": "helper_prompt"}) or {}
-        return result.get("prompt")
+    async def get_image_styles(self) -> None | list[str]:
+        return (await self._get("styles")).get("styles")
 
-    def set_main_prompt(self, prompt: str) -> None:
-        self.client.update_one({"_id": "main_prompt"}, {
-                               "$set": {"prompt": prompt}}, upsert=True)
+    async def add_image_styles(self, styles: list[str]) -> None:
+        await self._update("styles", {"$addToSet": {"styles": {"$each": styles}}})
 
-    def set_helper_prompt(self, prompt: str) -> None:
-        self.client.update_one({"_id": "helper_prompt"}, {
-                               "$set": {"prompt": prompt}}, upsert=True)
+    async def get_main_prompt(self) -> None | str:
+        return (await self._get("main_prompt")).get("prompt")
+
+    async def get_helper_prompt(self) -> None | str:
+        return (await self._get("helper_prompt")).get("prompt")
+
+    async def set_main_prompt(self, prompt: str) -> None:
+        await self._update("main_prompt", {"$set": {"prompt": prompt}}, upsert=True)
+
+    async def set_helper_prompt(self, prompt: str) -> None:
+        await self._update("helper_prompt", {"$set": {"prompt": prompt}}, upsert=True)
 
 
 class UserConfigDb(MongoDatabase):
-    def set_resolution(self, user_id: int, resolution: Resolution) -> None:
-        self.client.update_one(
+    """User configs are cached for a short time, last images are buffered and written in batches"""
+    PROJECTION = {"_id": 0, "resolution": 1, "style": 1, "last_image": 1}
+
+    def __init__(self, url, db_name, collection_name):
+        super().__init__(url, db_name, collection_name)
+        self.cache = TTLCache(USER_CONFIG_CACHE_SIZE, USER_CONFIG_CACHE_TTL_S)
+        self.flushed = 0
+        self._pending: dict[int, dict] = {}
+
+    async def ensure_indexes(self) -> None:
+        try:
+            await self.client.create_index("user_id", unique=True)
+        except OperationFailure as e:
+            logger.error(f"Can't create unique index on user_id, are there duplicated users? {e}")
+
+    async def set_resolution(self, user_id: int, resolution: Resolution) -> None:
+        await self.client.update_one(
             {"user_id": user_id},
             {"$set": {
                 "resolution": list(resolution),
             }},
             upsert=True
         )
+        self.cache.pop(user_id)
 
-    def set_style(self, user_id: int, style: str) -> None:
-        self.client.update_one(
+    async def set_style(self, user_id: int, style: str) -> None:
+        await self.client.update_one(
             {"user_id": user_id},
             {"$set": {
                 "style": style,
             }},
             upsert=True
         )
+        self.cache.pop(user_id)
 
-    def set_last_image(self, user_id: int, image_description: str) -> None:
-        self.client.update_one(
-            {"user_id": user_id},
-            {"$set": {
-                "last_image": image_description
-            }},
-            upsert=True
-        )
+    async def set_last_image(self, user_id: int, image_description: str) -> None:
+        """Saved on next flush"""
+        self._pending.setdefault(user_id, {})["last_image"] = image_description
+        config = self.cache.get(user_id, count=False)
+        if config is not None:
+            self.cache.set(user_id, config._replace(last_image=image_description))
+
+    async def get_user_config(self, user_id: int) -> UserConfig:
+        config = self.cache.get(user_id)
+        if config is not None:
+            return config
 
-    def get_user_config(self, user_id: int) -> UserConfig:
         default_config = UserConfig()
-        conf = self.client.find_one({"user_id": user_id}) or {}
-        return UserConfig(
+        conf = await self.client.find_one({"user_id": user_id}, projection=self.PROJECTION) or {}
+        conf.update(self._pending.get(user_id, {}))
+        config = UserConfig(
             resolution=Resolution(*conf.get("resolution", [])),
             style=conf.get("style", default_config.style),
+            last_image=conf.get("last_image", default_config.last_image),
         )
-    
+        self.cache.set(user_id, config)
+        return config
+
+    async def flush(self) -> None:
+        if not self._pending:
+            return
+        pending, self._pending = self._pending, {}
+        try:
+            await self.client.with_options(write_concern=WriteConcern(j=True)).bulk_write([
+                UpdateOne({"user_id": user_id}, {"$set": fields}, upsert=True)
+                for user_id, fields in pending.items()
+            ], ordered=False)
+        except BaseException:
+            # also when flusher is cancelled on shutdown, so close() can write them,
+            # newer values could be set while writing
+            for user_id, fields in pending.items():
+                self._pending[user_id] = fields | self._pending.get(user_id, {})
+            raise
+        self.flushed += len(pending)
+
+    async def run_flusher(self, interval_s: float = USER_CONFIG_FLUSH_INTERVAL_S) -> None:
+        while True:
+            await asyncio.sleep(interval_s)
+            try:
+                await self.flush()
+            except PyMongoError as e:
+                logger.error(f"Flushing {len(self._pending)} user configs failed: {e}")
+
+    async def close(self, attempts: int = 3) -> None:
+        """Flushes buffered writes before shutdown"""
+        for attempt in range(1, attempts + 1):
+            try:
+                await self.flush()
+                return
+            except PyMongoError as e:
+                logger.error(f"Final flush of user configs failed ({attempt}/{attempts}): {e}")
+                await asyncio.sleep(attempt)
+        logger.error(f"Lost {len(self._pending)} unsaved user configs")
+
+    def stats(self) -> dict:
+        return {"cache": self.cache.stats(), "pending": len(self._pending), "flushed": self.flushed}
+
 
 class NewsHistoryDb(MongoDatabase):
-    def add_article_url(self, url: str) -> None:
-        self.client.insert_one(
-            {"url": url}
+    async def ensure_indexes(self, retention_days: float = NEWS_RETENTION_DAYS) -> None:
+        try:
+            await self.remove_duplicates()
+            await self.client.create_index("url", unique=True)
+        except OperationFailure as e:
+            logger.error(f"Can't create unique index on url, creating non unique one: {e}")
+            await self.client.create_index("url")
+        if retention_days > 0:
+            try:
+                await self.client.create_index("created_at", expireAfterSeconds=int(retention_days * 24 * 60 * 60))
+            except OperationFailure as e:
+                logger.error(f"Can't create news history TTL index: {e}")
+
+    async def remove_duplicates(self) -> None:
+        """Older versions could post the same link twice, only the first record of url is kept"""
+        duplicates = self.client.aggregate([
+            {"$sort": {"_id": 1}},
+            {"$group": {"_id": "$url", "ids": {"$push": "$_id"}, "count": {"$sum": 1}}},
+            {"$match": {"count": {"$gt": 1}}},
+        ])
+        ids = [_id async for group in duplicates for _id in group["ids"][1:]]
+        if ids:
+            result = await self.client.delete_many({"_id": {"$in": ids}})
+            logger.warning(f"Removed {result.deleted_count} duplicated news history records")
+
+    async def add_article_url(self, url: str) -> None:
+        await self.client.update_one(
+            {"url": url},
+            {"$setOnInsert": {"created_at": datetime.utcnow()}},
+            upsert=True
+        )
+
+    async def get_excluded_urls(self, candidates: list[str]) -> set[str]:
+        """Returns which of `candidates` were already posted"""
+        cursor = self.client.find({"url": {"$in": candidates}}, projection={"_id": 0, "url": 1})
+        return {article["url"] async for article in cursor}
+
+
+class ChatHistoryDb(MongoDatabase):
+    """Last messages of every user in every chat, capped by the database on write"""
+    def __init__(self, url, db_name, collection_name, max_store: int = 10):
+        super().__init__(url, db_name, collection_name)
+        self.max_store = max_store
+
+    async def get_history(self, chat_id: int, user_id: int) -> CappedList:
+        result = await self.client.find_one(
+            {"_id": f"{chat_id}:{user_id}"},
+            projection={"_id": 0, "messages": {"$slice": -self.max_store}}
+        ) or {}
+        return CappedList(result.get("messages", []), max_store=self.max_store)
+
+    async def add_messages(self, chat_id: int, user_id: int, messages: list[str]) -> None:
+        await self.client.update_one(
+            {"_id": f"{chat_id}:{user_id}"},
+            {"$push": {"messages": {"$each": messages, "$slice": -self.max_store}}},
+            upsert=True
+        )
+
+    async def clear(self, chat_id: int, user_id: int) -> None:
+        await self.client.delete_one({"_id": f"{chat_id}:{user_id}"})
+
+
+class InspirationsDb(MongoDatabase):
+    async def add_inspirations(self, theme: str, inspirations: list[str]) -> None:
+        await self.client.update_one(
+            {"_id": theme},
+            {"$push": {"inspirations": {"$each": inspirations}}},
+            upsert=True
+        )
+
+    async def pop_inspiration(self, theme: str) -> None | str:
+        result = await self.client.find_one_and_update(
+            {"_id": theme, "inspirations.0": {"$exists": True}},
+            {"$pop": {"inspirations": -1}},
+            projection={"inspirations": {"$slice": 1}}
+        ) or {}
+        return next(iter(result.get("inspirations", [])), None)
+
+    async def count_inspirations(self) -> dict[str, int]:
+        return {
+            result["_id"]: result["count"]
+            async for result in self.client.aggregate([
+                {"$project": {"count": {"$size": {"$ifNull": ["$inspirations", []]}}}}
+            ])
+        }
+
+
+class PostQueueDb(MongoDatabase):
+    """Ready posts, their images are kept in GridFS so a post can't exceed document size limit"""
+    def __init__(self, url, db_name, collection_name):
+        super().__init__(url, db_name, collection_name)
+        self.fs = AsyncIOMotorGridFSBucket(get_client(url)[db_name], bucket_name=collection_name)
+
+    async def push_post(self, post: Post) -> None:
+        image_ids = [await self.fs.upload_from_stream("image.png", image) for image in post.images]
+        await self.client.insert_one({
+            "text": post.text,
+            "image_ids": image_ids,
+            "created_at": datetime.utcnow(),
+        })
+
+    async def pop_post(self) -> None | Post:
+        result = await self.client.find_one_and_delete({}, sort=[("created_at", pymongo.ASCENDING)])
+        if result is None:
+            return None
+        # posts queued before images were moved to GridFS
+        images = result.get("images", [])
+        for image_id in result.get("image_ids", []):
+            stream = await self.fs.open_download_stream(image_id)
+            images.append(await stream.read())
+            await self.fs.delete(image_id)
+        return Post(result["text"], images)
+
+
+class ImageFileDb(MongoDatabase):
+    """Telegram file ids of already uploaded images by hash of their content"""
+    async def get_file_id(self, image_hash: str, kind: str) -> None | str:
+        result = await self.client.find_one({"_id": f"{kind}:{image_hash}"}) or {}
+        return result.get("file_id")
+
+    async def set_file_id(self, image_hash: str, kind: str, file_id: str) -> None:
+        await self.client.update_one(
+            {"_id": f"{kind}:{image_hash}"},
+            {"$set": {"file_id": file_id}},
+            upsert=True
         )
 
-    def get_excluded_urls(self) -> list[str]:
-        return [article["url"] for article in self.get_all()]
-    
\ No newline at end of file
+    async def forget_file_ids(self, image_hashes: list[str], kind: str) -> int:
+        """Removes file ids which Telegram doesn't accept anymore, returns how many were stored"""
+        ids = [f"{kind}:{image_hash}" for image_hash in image_hashes]
+        result = await self.client.delete_many({"_id": {"$in": ids}})
+        return result.deleted_count
@@ -1,10 +1,13 @@
 from typing import NamedTuple
 import asyncio
+import os
 from datetime import datetime
 
-import aiohttp
 from bs4 import BeautifulSoup
 
+from http_client import HttpClient
+from mongo import NewsHistoryDb
+
 
 class NewsParserError(Exception):
     ...
@@ -16,40 +19,52 @@ class Article(NamedTuple):
 
 
 class NewsParser:
-    BASE_URL = "https://positivnews.ru/"
+    BASE_URL = os.getenv("NEWS_URL", "https://positivnews.ru/")
 
-    def __init__(self) -> None:
+    def __init__(self, http_client: HttpClient, history: NewsHistoryDb | None = None) -> None:
+        self.http_client = http_client
+        self.history = history
         self.headers = {
             "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/111.0.0.0 Safari/537.36"
         }
 
     # NOTE: might be reasonable to get news from different pages
-    async def get_latest_link(self, excluded_links: list[str]) -> str:
-        async with aiohttp.ClientSession(headers=self.headers) as session:
-            async with session.get(self.BASE_URL) as response:
-                if response.status != 200:
-                    raise NewsParserError(
-                        f"Can not connect to {self.BASE_URL}")
-
-                html = await response.text()
-                soup = BeautifulSoup(html, "html.parser")
-
-                a_tags = soup.select(".post-title a")
-                times = soup.select(".entry-date")
+    async def get_links(self) -> list[str]:
+        session = self.http_client.session(self.BASE_URL, self.headers)
+        async with session.get(self.BASE_URL) as response:
+            if response.status != 200:
+                raise NewsParserError(
+                    f"Can not connect to {self.BASE_URL}")
+
+            html = await response.text()
+            soup = BeautifulSoup(html, "html.parser")
+
+            a_tags = soup.select(".post-title a")
+            times = soup.select(".entry-date")
                 
-                hrefs = []
-                for t in times:
-                    href = t.parent["href"]
-                    hrefs.append(href) if href not in hrefs else ...
+            hrefs = []
+            for t in times:
+                href = t.parent["href"]
+                hrefs.append(href) if href not in hrefs else ...
+            return hrefs
+
+    async def get_latest_link(self) -> str | None:
+        """Returns the latest link which wasn't posted yet"""
+        hrefs = await self.get_links()
+        if not hrefs:
+            return None
+        excluded_links = await self.history.get_excluded_urls(hrefs) if self.history is not None else set()
+        # the oldest link is reposted when all of them were posted, as before
+        return next((href for href in hrefs if href not in excluded_links), hrefs[-1])
 
-                latest_link = hrefs.pop(0) if hrefs else None
-                while latest_link in excluded_links and hrefs:
-                    latest_link = hrefs.pop(0)
 
-                return latest_link
+async def main():
+    http_client = HttpClient()
+    try:
+        print(await NewsParser(http_client).get_latest_link())
+    finally:
+        await http_client.close()
 
 
 if __name__ == "__main__":
-    print(
-        asyncio.run(NewsParser().get_latest_link([]))
-    )
+    asyncio.run(main())
@@ -0,0 +1,56 @@
+from collections import defaultdict, deque
+from typing import Hashable, Iterator
+
+
+def quantile(values: list[float], q: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+class GenerationTimes:
+    """Learns how long jobs take to predict when to ask about their status.
+
+    Jobs are described by keys from the most to the least specific one,
+    e.g. `[(resolution, style), resolution, None]`, the most specific key with enough samples is used.
+    """
+    def __init__(
+        self,
+        default_s: float = 20,
+        min_interval_s: float = 0.5,
+        max_interval_s: float = 8,
+        window: int = 50,
+        min_samples: int = 5,
+    ) -> None:
+        self.default_s = default_s
+        self.min_interval_s = min_interval_s
+        self.max_interval_s = max_interval_s
+        self.min_samples = min_samples
+        self._times: dict[Hashable, deque[float]] = defaultdict(lambda: deque(maxlen=window))
+
+    def add(self, keys: list[Hashable], duration_s: float) -> None:
+        for key in keys:
+            self._times[key].append(duration_s)
+
+    def expected_window(self, keys: list[Hashable]) -> tuple[float, float]:
+        """Returns time after which job is likely to be done and time by which it almost surely is"""
+        for key in keys:
+            times = self._times.get(key)
+            if times is not None and len(times) >= self.min_samples:
+                return quantile(times, 0.1), quantile(times, 0.9)
+        return self.default_s / 2, self.default_s
+
+    def schedule(self, keys: list[Hashable], deadline_s: float) -> Iterator[float]:
+        """Yields delays before each status check: first one at the start of expected window,
+        often during the window and with exponential backoff after it"""
+        start, end = self.expected_window(keys)
+        interval = max(self.min_interval_s, (end - start) / 8)
+        delay = min(start, deadline_s)
+        elapsed = 0.0
+        while elapsed + delay <= deadline_s:
+            yield delay
+            elapsed += delay
+            if elapsed >= end:
+                interval = min(interval * 2, self.max_interval_s)
+            delay = interval
+        if elapsed < deadline_s:
+            yield deadline_s - elapsed
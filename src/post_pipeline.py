@@ -0,0 +1,72 @@
+import asyncio
+import logging
+import random
+
+from async_model import AsyncMotyaModel
+from models import Post
+from mongo import BotConfigDb, PostQueueDb
+from resilience import backoff_delay
+
+
+logger = logging.getLogger("post_pipeline")
+
+
+class PostPipeline:
+    """Generates scheduled posts ahead of time, so at post time they only have to be published"""
+    IMAGES_AMOUNT = [1, 3]
+
+    def __init__(
+        self,
+        model: AsyncMotyaModel,
+        config_db: BotConfigDb,
+        queue_db: PostQueueDb,
+        ready_size: int = 2,
+        retry_base_delay_s: float = 30,
+        retry_max_delay_s: float = 30 * 60,
+    ) -> None:
+        self.model = model
+        self.config_db = config_db
+        self.queue_db = queue_db
+        self.ready_size = ready_size
+        self.retry_base_delay_s = retry_base_delay_s
+        self.retry_max_delay_s = retry_max_delay_s
+        self.generated = 0
+        self.failed = 0
+        self._consumed = asyncio.Event()
+
+    async def generate(self) -> Post:
+        themes = await self.config_db.get_themes()
+        styles = await self.config_db.get_image_styles()
+        images = random.choice(self.IMAGES_AMOUNT)
+        return await self.model.create_random_post_with_images(themes, images, styles)
+
+    async def run(self) -> None:
+        fails = 0
+        while True:
+            # any error, including Mongo ones, is retried, so the pipeline can't silently stop
+            try:
+                if await self.queue_db.count() >= self.ready_size:
+                    self._consumed.clear()
+                    await self._consumed.wait()
+                    continue
+
+                post = await self.generate()
+                await self.queue_db.push_post(post)
+                self.generated += 1
+                logger.info(f"Post is ready, {await self.queue_db.count()} in queue")
+            except Exception as e:
+                fails += 1
+                self.failed += 1
+                delay = backoff_delay(fails, self.retry_base_delay_s, self.retry_max_delay_s)
+                logger.error(f"Post generation failed: {e!r}. Retrying in {delay:.0f} s")
+                await asyncio.sleep(delay)
+                continue
+            fails = 0
+
+    async def pop(self) -> Post:
+        post = await self.queue_db.pop_post()
+        self._consumed.set()
+        if post is None:
+            logger.warning("No ready posts, generating post right now")
+            post = await self.generate()
+        return post
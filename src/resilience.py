@@ -0,0 +1,89 @@
+import logging
+import random
+import time
+
+
+logger = logging.getLogger("resilience")
+
+
+class CircuitOpenError(Exception):
+    ...
+
+
+def backoff_delay(fails: int, base_s: float = 0.5, max_s: float = 30) -> float:
+    """Exponential backoff with full jitter"""
+    return random.uniform(0, min(max_s, base_s * 2 ** (fails - 1)))
+
+
+class CircuitBreaker:
+    """Fails fast after `failure_threshold` failures in a row, lets one trial call through after `reset_timeout_s`,
+    another one if the trial didn't finish in `reset_timeout_s`"""
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, name: str, failure_threshold: int = 5, reset_timeout_s: float = 30) -> None:
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout_s = reset_timeout_s
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.trial_at = 0.0
+        self.rejected = 0
+
+    def check(self) -> None:
+        if self.state == self.CLOSED:
+            return
+        now = time.monotonic()
+        if self.state == self.OPEN and now - self.opened_at >= self.reset_timeout_s:
+            logger.info(f"Circuit {self.name} is half open, trying one call")
+            self.state = self.HALF_OPEN
+            self.trial_at = now
+            return
+        if self.state == self.HALF_OPEN and now - self.trial_at >= self.reset_timeout_s:
+            logger.warning(f"Trial call of circuit {self.name} didn't finish, trying another one")
+            self.trial_at = now
+            return
+        self.rejected += 1
+        raise CircuitOpenError(f"{self.name} is unavailable")
+
+    def record_success(self) -> None:
+        if self.state != self.CLOSED:
+            logger.info(f"Circuit {self.name} is closed")
+        self.state = self.CLOSED
+        self.failures = 0
+
+    def record_failure(self) -> None:
+        self.failures += 1
+        if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+            if self.state != self.OPEN:
+                logger.warning(f"Circuit {self.name} is open after {self.failures} failures")
+            self.state = self.OPEN
+            self.opened_at = time.monotonic()
+
+    def stats(self) -> dict:
+        return {"state": self.state, "failures": self.failures, "rejected": self.rejected}
+
+
+class RetryBudget:
+    """Token bucket shared by all requests, every retry spends one token"""
+    def __init__(self, capacity: float = 20, refill_per_s: float = 1) -> None:
+        self.capacity = capacity
+        self.refill_per_s = refill_per_s
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+        self.exhausted = 0
+
+    def try_spend(self) -> bool:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.refill_per_s)
+        self.updated_at = now
+        if self.tokens < 1:
+            self.exhausted += 1
+            return False
+        self.tokens -= 1
+        return True
+
+    def stats(self) -> dict:
+        return {"tokens": int(self.tokens), "exhausted": self.exhausted}
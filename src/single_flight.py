@@ -0,0 +1,32 @@
+from typing import Any, Awaitable, Callable, Hashable
+import asyncio
+
+
+class SingleFlight:
+    """Runs at most one coroutine per key, concurrent callers with the same key share its result"""
+    def __init__(self) -> None:
+        self.calls = 0
+        self.coalesced = 0
+        self._in_flight: dict[Hashable, asyncio.Task] = {}
+
+    def __len__(self) -> int:
+        return len(self._in_flight)
+
+    async def do(self, key: Hashable, func: Callable[[], Awaitable[Any]]) -> Any:
+        task = self._in_flight.get(key)
+        if task is None:
+            self.calls += 1
+            task = asyncio.ensure_future(func())
+            self._in_flight[key] = task
+            task.add_done_callback(lambda _: self._in_flight.pop(key, None))
+        else:
+            self.coalesced += 1
+        # shield so that one cancelled caller does not cancel the query for the others
+        return await asyncio.shield(task)
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "in_flight": len(self._in_flight),
+            "calls": self.calls,
+            "coalesced": self.coalesced,
+        }
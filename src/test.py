@@ -2,35 +2,62 @@ import os
 import random
 from string import ascii_letters
 import asyncio
+import base64
+import io
+import json
+import time
 
 from dotenv import load_dotenv
 import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestClient, TestServer
+from pymongo import UpdateOne
+from pymongo.errors import OperationFailure
+from pymongo.results import DeleteResult
 
 from async_model import AsyncMotyaModel
-from mongo import BotConfigDb
-from models import CappedList
+from image_gen import ImageGenerator, ImageGenerationError, PocketPoller, read_base64_field
+from http_client import HttpClient
+from news_parser import NewsParser
+from image_cache import ImageCache
+from image_queue import ImageJobQueue
+from transcoder import Transcoder
+from throttling import RateLimiter, MemoryBuckets
+from webhook import WebhookServer, SECRET_HEADER
+from mongo import BotConfigDb, UserConfigDb, NewsHistoryDb, ChatHistoryDb, ImageFileDb, CHANGE_STREAMS_UNSUPPORTED
+from models import CappedList, Prompt, UserConfig, Post
+from post_pipeline import PostPipeline
+from cache import TTLCache
+from single_flight import SingleFlight
+from batcher import PredictionBatcher
+from inspirations import InspirationPool
+from fakes import FakeMindsDb
+from mindsdb_pool import MindsDbPool, PoolConfig
+from polling import GenerationTimes
+from resilience import CircuitBreaker, CircuitOpenError, RetryBudget
 
 
 load_dotenv()
 config_db = BotConfigDb(os.getenv("MONGO_URL"), "motya_gpt", "config")
 
 
-def test_getting_themes():
-    themes = config_db.get_themes()
+@pytest.mark.asyncio
+async def test_getting_themes():
+    themes = await config_db.get_themes()
     assert themes is not None, "No themes for a new post"
 
 
 @pytest.mark.asyncio
 async def test_creates_random_post():
     motya = await AsyncMotyaModel.create()
-    themes = config_db.get_themes()
+    themes = await config_db.get_themes()
     post = await motya.create_random_post(themes)
     assert isinstance(post, str), "Must be a string!"
 
 
 def test_chat_queue():
     max_store = 10
-    queue = CappedList(max_store)
+    queue = CappedList(max_store=max_store)
     for _ in range(10000):
         msg = "".join(random.choices(ascii_letters, k=10))
         queue.add_message(msg)
@@ -39,7 +66,707 @@ def test_chat_queue():
             queue) <= max_store, f"Queue size must not exceed {max_store} elements"
 
 
+def test_history_dialog_fits_max_length():
+    history = CappedList(["a" * 10, "b" * 10, "c" * 10], max_store=2)
+    assert list(history) == ["b" * 10, "c" * 10]
+    assert history.dialog(100) == f"-{'b' * 10}\n-{'c' * 10}"
+    assert history.dialog(20) == f"-{'c' * 10}", "Only the latest messages that fit must stay"
+    assert history.dialog(5) == ""
+
+
+def test_ttl_cache():
+    cache = TTLCache(max_size=2, ttl=60)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1
+    cache.set("c", 3)
+    assert cache.get("b") is None, "Least recently used item must be evicted"
+    assert cache.get("a") == 1 and cache.get("c") == 3
+
+    cache.ttl = 0
+    cache.set("d", 4)
+    time.sleep(0.001)
+    assert cache.get("d") is None, "Expired item must not be returned"
+    assert cache.stats() == {"size": 1, "hits": 3, "misses": 2, "evictions": 3}
+
+
+@pytest.mark.asyncio
+async def test_single_flight_coalesces_calls():
+    single_flight = SingleFlight()
+    executions = 0
+
+    async def query():
+        nonlocal executions
+        executions += 1
+        await asyncio.sleep(0.01)
+        return "answer"
+
+    results = await asyncio.gather(*[single_flight.do("key", query) for _ in range(5)])
+    assert results == ["answer"] * 5
+    assert executions == 1, "Identical concurrent calls must run once"
+    assert single_flight.stats() == {"in_flight": 0, "calls": 1, "coalesced": 4}
+
+
+@pytest.mark.asyncio
+async def test_batcher_routes_rows_to_callers():
+    queries = []
+
+    async def execute(command, model_name):
+        queries.append(command)
+        return [(1, "second"), (0, "first")]
+
+    batcher = PredictionBatcher(execute, window_s=0.01)
+    results = await asyncio.gather(
+        batcher.submit("mindsdb.model", "a"),
+        batcher.submit("mindsdb.model", "b"),
+    )
+    assert results == ["first", "second"]
+    assert len(queries) == 1, "Requests in one window must be sent as one query"
+    assert "JOIN mindsdb.model" in queries[0]
+
+
+def test_circuit_breaker_fails_fast():
+    breaker = CircuitBreaker("model", failure_threshold=2, reset_timeout_s=60)
+    breaker.record_failure()
+    breaker.check()
+    breaker.record_failure()
+    with pytest.raises(CircuitOpenError):
+        breaker.check()
+
+    breaker.reset_timeout_s = 0
+    breaker.check()
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    breaker.reset_timeout_s = 60
+    with pytest.raises(CircuitOpenError):
+        breaker.check()
+    breaker.record_success()
+    assert breaker.state == CircuitBreaker.CLOSED
+
+
+def test_circuit_breaker_allows_new_trial_after_hanging_one():
+    breaker = CircuitBreaker("model", failure_threshold=1, reset_timeout_s=0.05)
+    breaker.record_failure()
+    time.sleep(0.05)
+    breaker.check()
+    with pytest.raises(CircuitOpenError):
+        breaker.check()
+    time.sleep(0.05)
+    breaker.check()
+    assert breaker.state == CircuitBreaker.HALF_OPEN, "Another trial must be let through"
+
+
+@pytest.mark.asyncio
+async def test_cancelled_trial_call_reopens_circuit():
+    model = AsyncMotyaModel()
+    hanging = asyncio.Event()
+
+    async def query(text, model_name):
+        hanging.set()
+        await asyncio.sleep(60)
+
+    model._query = query
+    breaker = model.breakers["mindsdb.motya_model"]
+    breaker.reset_timeout_s = 0
+    breaker.state, breaker.opened_at = CircuitBreaker.OPEN, 0
+
+    task = asyncio.create_task(model._answer("hi", "mindsdb.motya_model"))
+    await hanging.wait()
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    task.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await task
+    assert breaker.state == CircuitBreaker.OPEN, "Cancelled trial must be recorded as failure"
+
+
+def test_retry_budget_is_limited():
+    budget = RetryBudget(capacity=3, refill_per_s=0)
+    assert [budget.try_spend() for _ in range(4)] == [True, True, True, False]
+
+
+@pytest.mark.asyncio
+async def test_inspiration_pool_refills_in_background():
+    class FakeModel:
+        calls = 0
+
+        async def get_inspirations(self, theme, cached=False):
+            self.calls += 1
+            return [f" {theme} {i}" for i in range(3)]
+
+    class FakeDb:
+        def __init__(self):
+            self.stored = {"cats": ["cats stored"]}
+
+        async def count_inspirations(self):
+            return {theme: len(items) for theme, items in self.stored.items()}
+
+        async def add_inspirations(self, theme, inspirations):
+            self.stored.setdefault(theme, []).extend(inspirations)
+
+        async def pop_inspiration(self, theme):
+            items = self.stored.get(theme)
+            return items.pop(0) if items else None
+
+    model = FakeModel()
+    pool = InspirationPool(model, FakeDb(), low_watermark=2)
+    assert await pool.draw(["cats"]) == "cats stored"
+    assert model.calls == 0, "Stored inspiration must be used without calling model"
+    await asyncio.sleep(0)
+    assert pool.sizes["cats"] == 3, "Pool must be refilled when it runs low"
+    assert await pool.draw(["cats"]) == "cats 0"
+
+
+@pytest.mark.asyncio
+async def test_model_answers_through_fake_mindsdb():
+    mindsdb = FakeMindsDb(responder=lambda model_name, text: f"{model_name}: {text}")
+    await mindsdb.start()
+    motya = await AsyncMotyaModel.create(pool_config=PoolConfig("127.0.0.1", mindsdb.port))
+    try:
+        assert await motya.answer('"привет"') == "mindsdb.motya_model: привет"
+        assert mindsdb.queries == 1
+    finally:
+        await motya.close()
+        await mindsdb.close()
+
+
+@pytest.mark.asyncio
+async def test_mindsdb_pool_limits_models():
+    mindsdb = FakeMindsDb()
+    await mindsdb.start()
+    pool = await MindsDbPool.create(
+        "user", "password", PoolConfig("127.0.0.1", mindsdb.port, maxsize=4), model_limits={"slow": 1}
+    )
+
+    async def use(model_name):
+        async with pool.acquire(model_name):
+            pass
+
+    try:
+        async with pool.acquire("slow"):
+            second = asyncio.create_task(use("slow"))
+            async with pool.acquire("fast"):
+                await asyncio.sleep(0.1)
+                stats = pool.stats()
+                assert stats["in_use"] == {"slow": 1, "fast": 1}, "Second slow call must wait for its model limit"
+                assert stats["utilization"] == 0.5
+        await second
+        stats = pool.stats()
+        assert stats["acquired"] == 3
+        assert stats["in_use"] == {"slow": 0, "fast": 0}
+        assert stats["wait_max_s"] >= 0.1, "Waiting for model limit must be measured"
+    finally:
+        pool.close()
+        await pool.wait_closed()
+        await mindsdb.close()
+
+
+@pytest.mark.asyncio
+async def test_images_are_generated_concurrently():
+    class FlakyGenerator(ImageGenerator):
+        async def _get_image(self, session, prompt):
+            await asyncio.sleep(0.05)
+            if prompt.text == "bad":
+                raise ImageGenerationError("bad prompt")
+            return prompt.text.encode()
+
+    http_client = HttpClient()
+    image_gen = FlakyGenerator(http_client, concurrency=3)
+    start = time.monotonic()
+    images = await image_gen.get_images([Prompt("a"), Prompt("bad"), Prompt("b")])
+    assert images == [b"a", b"b"], "Successful images must be returned despite failures"
+    assert time.monotonic() - start < 0.1, "Images must be generated concurrently"
+    with pytest.raises(ImageGenerationError):
+        await image_gen.get_images([Prompt("bad")])
+    await http_client.close()
+
+
+def test_status_polling_learns_generation_time():
+    times = GenerationTimes(default_s=20, min_interval_s=0.5, max_interval_s=8)
+    delays = list(times.schedule(["key"], deadline_s=100))
+    assert delays[0] == 10, "Without samples first check must be at half of default time"
+    assert sum(delays) == 100
+
+    times.add(["key"], 4)
+    times.add(["key"], 6)
+    assert next(times.schedule(["key", None], deadline_s=100)) == 10, "Too few samples must not be used"
+    times.add(["key"] * 3, 5)
+    delays = list(times.schedule(["key"], deadline_s=30))
+    assert delays[0] == 4
+    assert delays[1:4] == [0.5] * 3, "Status must be checked often in expected window"
+    assert delays[5] > delays[4], "Delays must grow after expected window"
+    assert sum(delays) == 30
+
+
+@pytest.mark.asyncio
+async def test_pocket_poller_checks_pockets_together():
+    ready = {"a", "b"}
+
+    async def check_status(session, pocket_id):
+        return pocket_id in ready
+
+    async def get_image_bytes(session, pocket_id):
+        return pocket_id.encode()
+
+    times = GenerationTimes(default_s=0.1, min_interval_s=0.05)
+    poller = PocketPoller(check_status, get_image_bytes, times, tick_s=0.05)
+    start = time.monotonic()
+    results = await asyncio.gather(*[poller.wait(None, pocket_id, ["key"], start, 1) for pocket_id in "ab"])
+    assert results == [b"a", b"b"]
+    assert poller.stats() == {"pockets": 0, "checks": 2, "wakeups": 1}, "Pockets must be checked in one wakeup"
+
+    with pytest.raises(ImageGenerationError):
+        await poller.wait(None, "never", ["key"], time.monotonic(), 0.2)
+
+
+@pytest.mark.asyncio
+async def test_image_cache_is_bounded(tmp_path):
+    cache = ImageCache(tmp_path, max_bytes=10)
+    await cache.set(Prompt("cat"), b"12345")
+    await cache.set(Prompt("dog"), b"12345")
+    assert await cache.get(Prompt(" Cat ")) == b"12345", "Prompts must be normalized"
+    await cache.set(Prompt("fox"), b"12345")
+    assert await cache.get(Prompt("dog")) is None, "Least recently used image must be evicted"
+    assert len(list(tmp_path.glob("*.png"))) == 2
+
+    cache = ImageCache(tmp_path, max_bytes=10)
+    assert await cache.get(Prompt("fox")) == b"12345", "Cache must survive restarts"
+
+
+@pytest.mark.asyncio
+async def test_image_is_decoded_from_stream():
+    image = bytes(range(256)) * 10
+    body = json.dumps({"result": [{"response": [base64.b64encode(image).decode()]}]}).encode()
+    body = body.replace(b"/", b"\\/")
+
+    class FakeContent:
+        async def iter_chunked(self, size):
+            for start in range(0, len(body), size):
+                yield body[start:start + size]
+
+    for chunk_size in [1, 5, 7, 1024]:
+        assert await read_base64_field(FakeContent(), chunk_size=chunk_size) == image
+
+
+@pytest.mark.asyncio
+async def test_image_queue_is_fair():
+    order = []
+    release = asyncio.Event()
+
+    class FakeImageGen:
+        async def get_images(self, prompts, force_new=False):
+            await release.wait()
+            order.append(prompts[0].text)
+            return [prompts[0].text.encode()]
+
+    queue = ImageJobQueue(FakeImageGen(), workers=1)
+    jobs = [queue.submit(1, [Prompt(f"spam {i}")]) for i in range(3)]
+    jobs.append(queue.submit(2, [Prompt("cat")]))
+    jobs.append(queue.submit(0, [Prompt("post")], priority=-1))
+    assert [queue.position(job) for job in jobs] == [0, 2, 3, 1, 4]
+
+    queue.start()
+    await jobs[0].started.wait()
+    release.set()
+    assert await asyncio.gather(*(job.future for job in jobs))
+    assert order == ["spam 0", "cat", "spam 1", "spam 2", "post"], "Users must take turns"
+    assert queue.stats() == {"queued": 0, "done": 5, "failed": 0}
+    await queue.close()
+
+
+@pytest.mark.asyncio
+async def test_image_queue_ages_waiting_jobs():
+    class FakeImageGen:
+        async def get_images(self, prompts, force_new=False):
+            return [b""]
+
+    queue = ImageJobQueue(FakeImageGen(), workers=1, aging_s=10)
+    post = queue.submit(0, [Prompt("post")], priority=-1)
+    post.submitted_at -= 15
+    user = queue.submit(1, [Prompt("cat")])
+    assert queue._next_job() is post, "Job waiting long enough must overtake higher priority"
+    assert queue._next_job() is user
+
+    waiting = queue.submit(1, [Prompt("dog")])
+    await queue.close()
+    assert waiting.started.is_set() and waiting.future.cancelled(), "Nobody must wait for cancelled jobs"
+
+
+@pytest.mark.asyncio
+async def test_image_queue_signals_taken_jobs():
+    class FakeImageGen:
+        async def get_images(self, prompts, force_new=False):
+            await asyncio.sleep(0.02)
+            return [b""]
+
+    queue = ImageJobQueue(FakeImageGen(), workers=1)
+    jobs = [queue.submit(user_id, [Prompt("cat")]) for user_id in range(4)]
+    last = jobs[-1]
+    queue.start()
+    positions = [queue.position(last)]
+    while not last.started.is_set():
+        await queue.wait_taken()
+        positions.append(queue.position(last))
+    assert positions == [3, 2, 1, 0, -1], "Waiters must see every change of position"
+    await queue.close()
+
+
+@pytest.mark.asyncio
+async def test_transcoder_shrinks_images():
+    assert await Transcoder("").transcode(b"png") == (b"png", "png", None), "Disabled transcoder must keep image"
+
+    Image = pytest.importorskip("PIL.Image")
+    out = io.BytesIO()
+    Image.effect_noise((1024, 1024), 64).convert("RGB").save(out, "png")
+    transcoder = Transcoder("jpeg", thumbnail_size=320, workers=1)
+    result = await transcoder.transcode(out.getvalue(), thumbnail=True)
+    assert (await transcoder.transcode(out.getvalue())).thumbnail is None, "Photos don't need thumbnails"
+    transcoder.close()
+    assert result.extension == "jpg"
+    assert len(result.image) < len(out.getvalue())
+    assert Image.open(io.BytesIO(result.thumbnail)).size == (320, 320)
+    assert transcoder.stats()["saved_ratio"] > 0
+
+
+@pytest.mark.asyncio
+async def test_bot_config_is_cached():
+    class FakeCursor:
+        def __init__(self, documents):
+            self.documents = documents
+
+        async def to_list(self, length):
+            return [dict(document) for document in self.documents]
+
+    class FakeCollection:
+        def __init__(self):
+            self.documents = {"themes": {"_id": "themes", "themes": ["cats"]}}
+            self.reads = 0
+
+        def find(self):
+            self.reads += 1
+            return FakeCursor(self.documents.values())
+
+        def watch(self, **kwargs):
+            raise OperationFailure("not a replica set", code=CHANGE_STREAMS_UNSUPPORTED)
+
+    db = BotConfigDb("mongodb://localhost", "motya_gpt", "config")
+    db.client = FakeCollection()
+    await db.load()
+    watching = asyncio.create_task(db.watch(poll_interval_s=0.01))
+    reads = db.client.reads
+    assert [await db.get_themes() for _ in range(3)] == [["cats"]] * 3
+    assert db.client.reads == reads, "Config must be read from memory"
+
+    db.client.documents["themes"] = {"_id": "themes", "themes": ["cats", "dogs"]}
+    await asyncio.sleep(0.05)
+    assert await db.get_themes() == ["cats", "dogs"], "Config must be reloaded without change streams"
+    watching.cancel()
+
+
+@pytest.mark.asyncio
+async def test_user_config_writes_are_batched():
+    class FakeCollection:
+        def __init__(self):
+            self.documents = {1: {"style": "anime"}}
+            self.reads = 0
+            self.bulk_writes = []
+
+        async def find_one(self, query, projection=None):
+            self.reads += 1
+            return dict(self.documents.get(query["user_id"], {}))
+
+        def with_options(self, **kwargs):
+            return self
+
+        async def bulk_write(self, requests, ordered=True):
+            self.bulk_writes.append(requests)
+
+    db = UserConfigDb("mongodb://localhost", "motya_gpt", "user_config")
+    db.client = FakeCollection()
+    await db.set_last_image(2, "dog")
+    assert (await db.get_user_config(1)).style == "anime"
+    await db.set_last_image(1, "cat")
+    await db.set_last_image(1, "cat with hat")
+    assert await db.get_user_config(1) == UserConfig(style="anime", last_image="cat with hat")
+    assert (await db.get_user_config(2)).last_image == "dog", "Buffered writes must be visible"
+    assert db.client.reads == 2, "Configs must be cached"
+
+    await db.close()
+    assert db.client.bulk_writes == [[
+        UpdateOne({"user_id": 2}, {"$set": {"last_image": "dog"}}, upsert=True),
+        UpdateOne({"user_id": 1}, {"$set": {"last_image": "cat with hat"}}, upsert=True),
+    ]], "Pending writes must be merged into one bulk write"
+    assert db.stats()["pending"] == 0
+
+
+@pytest.mark.asyncio
+async def test_cancelled_flush_keeps_user_configs():
+    class SlowCollection:
+        def __init__(self):
+            self.bulk_writes = []
+            self.slow = True
+
+        def with_options(self, **kwargs):
+            return self
+
+        async def bulk_write(self, requests, ordered=True):
+            if self.slow:
+                await asyncio.sleep(10)
+            self.bulk_writes.append(requests)
+
+    db = UserConfigDb("mongodb://localhost", "motya_gpt", "user_config")
+    db.client = SlowCollection()
+    await db.set_last_image(1, "cat")
+    flusher = asyncio.create_task(db.run_flusher(interval_s=0))
+    await asyncio.sleep(0.05)
+    flusher.cancel()
+    await asyncio.gather(flusher, return_exceptions=True)
+    assert db.stats()["pending"] == 1, "Writes of cancelled flush must be kept"
+
+    db.client.slow = False
+    await db.close()
+    assert db.client.bulk_writes == [[UpdateOne({"user_id": 1}, {"$set": {"last_image": "cat"}}, upsert=True)]]
+
+
+@pytest.mark.asyncio
+async def test_image_file_ids_are_reused_until_rejected():
+    class FakeCollection:
+        def __init__(self):
+            self.documents = {}
+
+        async def find_one(self, query):
+            return self.documents.get(query["_id"])
+
+        async def update_one(self, query, update, upsert=False):
+            self.documents.setdefault(query["_id"], {}).update(update["$set"])
+
+        async def delete_many(self, query):
+            deleted = [self.documents.pop(_id) for _id in query["_id"]["$in"] if _id in self.documents]
+            return DeleteResult({"n": len(deleted)}, acknowledged=True)
+
+    db = ImageFileDb("mongodb://localhost", "motya_gpt", "image_files")
+    db.client = FakeCollection()
+    await db.set_file_id("hash", "photo", "file-1")
+    assert await db.get_file_id("hash", "photo") == "file-1"
+    assert await db.get_file_id("hash", "document") is None, "Photos and documents must have their own file ids"
+
+    assert await db.forget_file_ids(["hash", "other"], "photo") == 1
+    assert await db.get_file_id("hash", "photo") is None, "Rejected file id must not be reused"
+    assert await db.forget_file_ids(["hash"], "photo") == 0, "Nothing to forget means upload already failed"
+
+
+@pytest.mark.asyncio
+async def test_news_history_indexes_survive_duplicates():
+    class FakeCollection:
+        def __init__(self, fail_unique):
+            self.fail_unique = fail_unique
+            self.indexes = []
+            self.deleted = []
+
+        async def _groups(self):
+            yield {"_id": "a", "ids": [1, 2, 3], "count": 3}
+
+        def aggregate(self, pipeline):
+            return self._groups()
+
+        async def delete_many(self, query):
+            self.deleted += query["_id"]["$in"]
+            return DeleteResult({"n": len(query["_id"]["$in"])}, acknowledged=True)
+
+        async def create_index(self, key, unique=False, **kwargs):
+            if unique and self.fail_unique:
+                raise OperationFailure("E11000 duplicate key error")
+            self.indexes.append((key, unique, kwargs))
+
+    db = NewsHistoryDb("mongodb://localhost", "motya_gpt", "news_history")
+    db.client = FakeCollection(fail_unique=False)
+    await db.ensure_indexes(retention_days=1)
+    assert db.client.deleted == [2, 3], "Only first record of url must be kept"
+    assert db.client.indexes == [("url", True, {}), ("created_at", False, {"expireAfterSeconds": 86400})]
+
+    db.client = FakeCollection(fail_unique=True)
+    await db.ensure_indexes(retention_days=1)
+    assert db.client.indexes == [("url", False, {}), ("created_at", False, {"expireAfterSeconds": 86400})], \
+        "Lookups by url and TTL must be indexed even without unique index"
+
+
+@pytest.mark.asyncio
+async def test_latest_news_link_skips_posted():
+    class FakeHistory:
+        posted = {"a", "b", "old"}
+
+        async def get_excluded_urls(self, candidates):
+            return self.posted & set(candidates)
+
+    class FakeParser(NewsParser):
+        links = ["a", "b", "c"]
+
+        async def get_links(self):
+            return self.links
+
+    parser = FakeParser(HttpClient(), FakeHistory())
+    assert await parser.get_latest_link() == "c"
+    parser.links = ["a", "b"]
+    assert await parser.get_latest_link() == "b", "The oldest link must be used when all were posted"
+
+
+@pytest.mark.asyncio
+async def test_chat_history_is_capped_by_database():
+    class FakeCollection:
+        def __init__(self):
+            self.documents = {}
+
+        async def update_one(self, query, update, upsert=False):
+            push = update["$push"]["messages"]
+            messages = self.documents.setdefault(query["_id"], []) + push["$each"]
+            self.documents[query["_id"]] = messages[push["$slice"]:]
+
+        async def find_one(self, query, projection=None):
+            messages = self.documents.get(query["_id"])
+            return {"messages": messages[projection["messages"]["$slice"]:]} if messages else None
+
+    db = ChatHistoryDb("mongodb://localhost", "motya_gpt", "chat_history", max_store=3)
+    db.client = FakeCollection()
+    assert list(await db.get_history(1, 2)) == []
+    await db.add_messages(1, 2, ["hi", "hello"])
+    await db.add_messages(1, 2, ["how are you?", "fine"])
+    assert list(await db.get_history(1, 2)) == ["hello", "how are you?", "fine"]
+    assert list(await db.get_history(1, 3)) == [], "History must be kept per user"
+
+
+@pytest.mark.asyncio
+async def test_rate_limiter_buckets():
+    limiter = RateLimiter(MemoryBuckets(sweep_interval_s=0))
+    limits = dict(rate=0.05, burst=2, chat_rate=0.05, chat_burst=3)
+    assert [await limiter.take("ask", 1, 10, **limits) for _ in range(3)] == [True, True, False]
+    assert await limiter.take("ask", 2, 10, **limits), "Users must have their own buckets"
+    assert not await limiter.take("ask", 3, 10, **limits), "Chat bucket must limit all users of a chat"
+
+    await asyncio.sleep(0.2)
+    assert await limiter.take("ask", 1, 10, **limits), "Buckets must refill"
+    assert limiter.stats() == {"allowed": 4, "throttled": 2, "buckets": 2}, "Full buckets must be removed"
+
+
+@pytest.mark.asyncio
+async def test_webhook_limits_and_drains_updates():
+    running = 0
+    max_running = 0
+    processed = []
+
+    async def process_update(update):
+        nonlocal running, max_running
+        running += 1
+        max_running = max(max_running, running)
+        await asyncio.sleep(0.05)
+        running -= 1
+        processed.append(update["update_id"])
+
+    server = WebhookServer(process_update, secret="secret", max_updates=2)
+    async with TestClient(TestServer(server.create_app("/webhook"))) as client:
+        response = await client.post("/webhook", json={"update_id": 0})
+        assert response.status == 401, "Updates without secret token must be rejected"
+
+        headers = {SECRET_HEADER: "secret"}
+        responses = await asyncio.gather(*[
+            client.post("/webhook", json={"update_id": i}, headers=headers) for i in range(5)
+        ])
+        assert [response.status for response in responses] == [200] * 5
+        await server.drain()
+        assert sorted(processed) == list(range(5)), "Running updates must finish before shutdown"
+        assert max_running == 2
+
+        response = await client.post("/webhook", json={"update_id": 5}, headers=headers)
+        assert response.status == 503
+    assert server.stats() == {"received": 5, "running": 0, "waiting": 0, "failed": 0, "rejected": 1}
+
+
+@pytest.mark.asyncio
+async def test_webhook_drain_rejects_updates_waiting_for_slot():
+    processed = []
+
+    async def process_update(update):
+        await asyncio.sleep(0.05)
+        processed.append(update["update_id"])
+
+    server = WebhookServer(process_update, secret=None, max_updates=1)
+    async with TestClient(TestServer(server.create_app("/webhook"))) as client:
+        posts = [asyncio.create_task(client.post("/webhook", json={"update_id": i})) for i in range(3)]
+        while server.stats()["waiting"] < 2:
+            await asyncio.sleep(0.01)
+        await server.drain()
+        assert processed == [0], "Updates waiting for a slot must not run after drain"
+        assert server.stats()["running"] == 0
+        assert sorted([(await post).status for post in posts]) == [200, 503, 503]
+
+
+@pytest.mark.asyncio
+async def test_http_client_reuses_connections_per_origin():
+    async def index(request):
+        return web.Response(text="ok")
+
+    app = web.Application()
+    app.router.add_get("/", index)
+    async with TestServer(app) as first, TestServer(app) as second:
+        first_url, second_url = first.make_url("/"), second.make_url("/")
+        http_client = HttpClient()
+        try:
+            for _ in range(3):
+                async with http_client.session(str(first_url)).get(first_url) as response:
+                    assert await response.text() == "ok"
+            async with http_client.session(str(second_url)).get(second_url) as response:
+                await response.read()
+            assert http_client.session(str(first_url / "a")) is http_client.session(str(first_url / "b"))
+            assert http_client.session(str(first_url)) is not http_client.session(str(second_url))
+
+            stats = http_client.stats()
+            assert stats[str(first_url.origin())] == {"created": 1, "reused": 2, "reuse_ratio": 2 / 3}
+            assert stats[str(second_url.origin())]["created"] == 1, "Origins must have their own connections"
+        finally:
+            await http_client.close()
+
+
+@pytest.mark.asyncio
+async def test_post_pipeline_survives_db_errors():
+    class FakeModel:
+        async def create_random_post_with_images(self, themes, images_amount, image_styles):
+            return Post(f"post about {themes[0]}", [b"image"])
+
+    class FakeConfigDb:
+        async def get_themes(self):
+            return ["cats"]
+
+        async def get_image_styles(self):
+            return ["anime"]
+
+    class FakeQueueDb:
+        def __init__(self):
+            self.posts = []
+            self.fail = True
+
+        async def count(self):
+            if self.fail:
+                self.fail = False
+                raise ConnectionError("mongo is down")
+            return len(self.posts)
+
+        async def push_post(self, post):
+            self.posts.append(post)
+
+        async def pop_post(self):
+            return self.posts.pop(0) if self.posts else None
+
+    queue_db = FakeQueueDb()
+    pipeline = PostPipeline(FakeModel(), FakeConfigDb(), queue_db, ready_size=2, retry_base_delay_s=0.01)
+    running = asyncio.create_task(pipeline.run())
+    await asyncio.sleep(0.05)
+    assert len(queue_db.posts) == 2, "Pipeline must keep running after database errors"
+    assert pipeline.failed == 1
+
+    assert await pipeline.pop() == Post("post about cats", [b"image"])
+    await asyncio.sleep(0.01)
+    assert len(queue_db.posts) == 2, "Consumed post must be replaced"
+    running.cancel()
+
+
 if __name__ == "__main__":
-    # test_getting_themes()
+    # asyncio.run(test_getting_themes())
     # asyncio.run(test_creates_random_post())
     test_chat_queue()
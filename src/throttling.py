@@ -0,0 +1,222 @@
+from typing import Callable
+import asyncio
+import functools
+import logging
+import os
+import time
+
+from aiogram import types
+
+try:
+    import redis.asyncio as redis
+except ImportError:
+    redis = None
+
+
+logger = logging.getLogger("throttling")
+# buckets are shared between replicas when url is set
+THROTTLE_REDIS_URL = os.getenv("THROTTLE_REDIS_URL")
+SWEEP_INTERVAL_S = 60
+USER = "user"
+CHAT = "chat"
+
+
+class Bucket:
+    """Token bucket which gets one token every `interval_s` up to `capacity` tokens"""
+    __slots__ = ("interval_s", "capacity", "tokens", "updated_at")
+
+    def __init__(self, interval_s: float, capacity: int, now: float) -> None:
+        self.interval_s = interval_s
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated_at = now
+
+    def refill(self, now: float) -> float:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) / self.interval_s)
+        self.updated_at = now
+        return self.tokens
+
+    def full_at(self) -> float:
+        return self.updated_at + (self.capacity - self.tokens) * self.interval_s
+
+
+class MemoryBuckets:
+    """Buckets of one process, full buckets are removed lazily since they are the same as new ones"""
+    def __init__(self, sweep_interval_s: float = SWEEP_INTERVAL_S) -> None:
+        self.sweep_interval_s = sweep_interval_s
+        self._buckets: dict[str, Bucket] = {}
+        self._swept_at = time.monotonic()
+
+    def __len__(self) -> int:
+        return len(self._buckets)
+
+    async def take(self, limits: list[tuple[str, float, int]]) -> int | None:
+        """Takes a token from every bucket in `limits` if all of them have one,
+        otherwise returns index of the first empty one"""
+        now = time.monotonic()
+        if now - self._swept_at >= self.sweep_interval_s:
+            self._sweep(now)
+
+        buckets = []
+        for i, (key, interval_s, capacity) in enumerate(limits):
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = Bucket(interval_s, capacity, now)
+            if bucket.refill(now) < 1:
+                return i
+            buckets.append(bucket)
+        for bucket in buckets:
+            bucket.tokens -= 1
+        return None
+
+    def _sweep(self, now: float) -> None:
+        self._buckets = {key: bucket for key, bucket in self._buckets.items() if bucket.full_at() > now}
+        self._swept_at = now
+
+    async def close(self) -> None:
+        ...
+
+
+class RedisBuckets:
+    """Buckets shared by all replicas, updated atomically by a script and expired by Redis when full"""
+    SCRIPT = """
+    local now = tonumber(ARGV[1])
+    local tokens = {}
+    for i, key in ipairs(KEYS) do
+        local interval, capacity = tonumber(ARGV[i * 2]), tonumber(ARGV[i * 2 + 1])
+        local bucket = redis.call("HMGET", key, "tokens", "updated_at")
+        local updated_at = tonumber(bucket[2]) or now
+        tokens[i] = math.min(capacity, (tonumber(bucket[1]) or capacity) + (now - updated_at) / interval)
+        if tokens[i] < 1 then
+            return i
+        end
+    end
+    for i, key in ipairs(KEYS) do
+        local interval, capacity = tonumber(ARGV[i * 2]), tonumber(ARGV[i * 2 + 1])
+        redis.call("HSET", key, "tokens", tokens[i] - 1, "updated_at", now)
+        redis.call("PEXPIRE", key, math.ceil((capacity - tokens[i] + 1) * interval * 1000))
+    end
+    return 0
+    """
+
+    def __init__(self, url: str, prefix: str = "throttle:") -> None:
+        if redis is None:
+            raise RuntimeError("redis package is required for shared throttling")
+        self.prefix = prefix
+        self.client = redis.from_url(url)
+        self._take = self.client.register_script(self.SCRIPT)
+
+    async def take(self, limits: list[tuple[str, float, int]]) -> int | None:
+        keys = [f"{self.prefix}{key}" for key, _, _ in limits]
+        args = [time.time()]
+        for _, interval_s, capacity in limits:
+            args += [interval_s, capacity]
+        # script counts buckets from 1 and returns 0 on success
+        empty = await self._take(keys=keys, args=args)
+        return empty - 1 if empty else None
+
+    async def close(self) -> None:
+        await self.client.aclose()
+
+
+class RateLimiter:
+    """Replacement for `Dispatcher.throttled` which doesn't go to FSM storage on every update"""
+    def __init__(self, backend: MemoryBuckets | RedisBuckets | None = None) -> None:
+        self.backend = backend if backend is not None else MemoryBuckets()
+        self.allowed = 0
+        self.throttled_count = 0
+
+    @classmethod
+    def from_env(cls, redis_url: str | None = THROTTLE_REDIS_URL) -> "RateLimiter":
+        if redis_url:
+            logger.info("Throttling buckets are shared through Redis")
+            return cls(RedisBuckets(redis_url))
+        return cls()
+
+    async def take(
+        self,
+        key: str,
+        user_id: int | None,
+        chat_id: int | None,
+        rate: float,
+        burst: int = 1,
+        chat_rate: float | None = None,
+        chat_burst: int = 1,
+    ) -> bool:
+        return await self._take(key, user_id, chat_id, rate, burst, chat_rate, chat_burst) is None
+
+    async def _take(
+        self,
+        key: str,
+        user_id: int | None,
+        chat_id: int | None,
+        rate: float,
+        burst: int,
+        chat_rate: float | None,
+        chat_burst: int,
+    ) -> str | None:
+        """Returns which limit was hit, `USER` or `CHAT`, None if call is allowed"""
+        limits, scopes = [], []
+        if user_id is not None:
+            limits.append((f"{key}:{chat_id}:{user_id}", rate, burst))
+            scopes.append(USER)
+        if chat_id is not None and chat_rate is not None:
+            limits.append((f"{key}:{chat_id}", chat_rate, chat_burst))
+            scopes.append(CHAT)
+        if not limits:
+            return None
+
+        empty = await self.backend.take(limits)
+        if empty is None:
+            self.allowed += 1
+            return None
+        self.throttled_count += 1
+        return scopes[empty]
+
+    def throttled(
+        self,
+        on_throttled: Callable | None = None,
+        rate: float = 1,
+        burst: int = 1,
+        chat_rate: float | None = None,
+        chat_burst: int = 1,
+        key: str | None = None,
+    ):
+        """Lets user call handler once in `rate` seconds with bursts of `burst` calls.
+
+        Optional `chat_rate` and `chat_burst` limit all users of a chat together,
+        updates over chat limit are dropped silently, since the user didn't spam.
+        """
+        def decorator(func):
+            @functools.wraps(func)
+            async def wrapped(*args, **kwargs):
+                user, chat = types.User.get_current(), types.Chat.get_current()
+                user_id = user.id if user else None
+                chat_id = chat.id if chat else None
+                scope = await self._take(
+                    key if key is not None else func.__name__,
+                    user_id, chat_id, rate, burst, chat_rate, chat_burst,
+                )
+                if scope is None:
+                    return await func(*args, **kwargs)
+                if scope == CHAT:
+                    return
+
+                kwargs.update({"rate": rate, "key": key, "user_id": user_id, "chat_id": chat_id})
+                if on_throttled is None:
+                    return
+                if asyncio.iscoroutinefunction(on_throttled):
+                    await on_throttled(*args, **kwargs)
+                else:
+                    on_throttled(*args, **kwargs)
+            return wrapped
+        return decorator
+
+    async def close(self) -> None:
+        await self.backend.close()
+
+    def stats(self) -> dict[str, int]:
+        stats = {"allowed": self.allowed, "throttled": self.throttled_count}
+        if isinstance(self.backend, MemoryBuckets):
+            stats["buckets"] = len(self.backend)
+        return stats
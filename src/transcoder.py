@@ -0,0 +1,105 @@
+from concurrent.futures import ProcessPoolExecutor
+from typing import NamedTuple
+import asyncio
+import io
+import logging
+import multiprocessing
+import os
+import time
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+
+logger = logging.getLogger("transcoder")
+# transcoding is disabled when format is empty
+IMAGE_FORMAT = os.getenv("IMAGE_FORMAT", "").lower()
+IMAGE_QUALITY = int(os.getenv("IMAGE_QUALITY", 85))
+# thumbnails aren't made when size is 0, Telegram allows up to 320
+THUMBNAIL_SIZE = int(os.getenv("THUMBNAIL_SIZE", 320))
+TRANSCODE_WORKERS = int(os.getenv("TRANSCODE_WORKERS", 2))
+FORMATS = {"jpeg": "jpg", "webp": "webp"}
+
+
+class TranscodedImage(NamedTuple):
+    image: bytes
+    extension: str = "png"
+    thumbnail: bytes | None = None
+
+
+def transcode(image: bytes, format: str, quality: int, thumbnail_size: int) -> TranscodedImage:
+    """Runs in worker process, original image is kept if transcoded one is bigger"""
+    with Image.open(io.BytesIO(image)) as original:
+        original = original.convert("RGB")
+        out = io.BytesIO()
+        original.save(out, format, quality=quality, optimize=True)
+        result = TranscodedImage(out.getvalue(), FORMATS[format])
+        if len(result.image) >= len(image):
+            result = TranscodedImage(image)
+
+        if thumbnail_size > 0:
+            original.thumbnail((thumbnail_size, thumbnail_size))
+            out = io.BytesIO()
+            original.save(out, "jpeg", quality=80)
+            result = result._replace(thumbnail=out.getvalue())
+    return result
+
+
+class Transcoder:
+    """Transcodes generated PNGs to smaller images in a process pool before upload"""
+    def __init__(
+        self,
+        format: str = IMAGE_FORMAT,
+        quality: int = IMAGE_QUALITY,
+        thumbnail_size: int = THUMBNAIL_SIZE,
+        workers: int = TRANSCODE_WORKERS,
+    ) -> None:
+        self.format = format
+        self.quality = quality
+        self.thumbnail_size = thumbnail_size
+        self.workers = workers
+        self.enabled = bool(format)
+        if format and format not in FORMATS:
+            raise ValueError(f"Unknown image format: {format}, expected one of {list(FORMATS)}")
+        if format and Image is None:
+            logger.warning("Pillow is not installed, images won't be transcoded")
+            self.enabled = False
+        self.images = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.transcode_s = 0.0
+        self._executor: ProcessPoolExecutor | None = None
+
+    async def transcode(self, image: bytes, thumbnail: bool = False) -> TranscodedImage:
+        """Thumbnails are made only when asked, Telegram uses them only for documents"""
+        if not self.enabled:
+            return TranscodedImage(image)
+        if self._executor is None:
+            # forking a process with running Mongo and aiohttp threads can copy their held locks
+            self._executor = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context("spawn"))
+
+        start = time.perf_counter()
+        result = await asyncio.get_running_loop().run_in_executor(
+            self._executor, transcode, image, self.format, self.quality, self.thumbnail_size if thumbnail else 0
+        )
+        self.transcode_s += time.perf_counter() - start
+        self.images += 1
+        self.bytes_in += len(image)
+        self.bytes_out += len(result.image)
+        return result
+
+    def close(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+    def stats(self) -> dict[str, float]:
+        return {
+            "images": self.images,
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out,
+            "saved_ratio": 1 - self.bytes_out / (self.bytes_in or 1) if self.images else 0,
+            "avg_transcode_s": self.transcode_s / (self.images or 1),
+        }
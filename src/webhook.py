@@ -0,0 +1,114 @@
+from typing import Awaitable, Callable
+import asyncio
+import hmac
+import logging
+import os
+
+from aiohttp import web
+
+
+logger = logging.getLogger("webhook")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", 8080))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+# public url of the bot without path, webhook mode is used when it is set
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+WEBHOOK_MAX_UPDATES = int(os.getenv("WEBHOOK_MAX_UPDATES", 40))
+WEBHOOK_DRAIN_TIMEOUT_S = float(os.getenv("WEBHOOK_DRAIN_TIMEOUT_S", 30))
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+class WebhookServer:
+    """Receives updates from Telegram and processes them in background.
+
+    At most `max_updates` updates are processed at once, when all slots are taken
+    the response is delayed, so Telegram sends less.
+    """
+    def __init__(
+        self,
+        process_update: Callable[[dict], Awaitable],
+        secret: str | None = WEBHOOK_SECRET,
+        max_updates: int = WEBHOOK_MAX_UPDATES,
+        drain_timeout_s: float = WEBHOOK_DRAIN_TIMEOUT_S,
+    ) -> None:
+        self.process_update = process_update
+        self.secret = secret
+        self.drain_timeout_s = drain_timeout_s
+        self.draining = False
+        self.received = 0
+        self.failed = 0
+        self.rejected = 0
+        self._slots = asyncio.Semaphore(max_updates)
+        self._tasks: set[asyncio.Task] = set()
+        # requests waiting for a free slot
+        self._waiting = 0
+
+    def create_app(self, path: str = WEBHOOK_PATH) -> web.Application:
+        app = web.Application()
+        app.router.add_post(path, self.handle)
+        return app
+
+    async def handle(self, request: web.Request) -> web.Response:
+        if self.secret and not hmac.compare_digest(request.headers.get(SECRET_HEADER, ""), self.secret):
+            self.rejected += 1
+            return web.Response(status=401)
+        if self.draining:
+            # Telegram will send the update again, probably to another replica
+            return web.Response(status=503)
+        try:
+            update = await request.json()
+        except ValueError:
+            self.rejected += 1
+            return web.Response(status=400)
+
+        self._waiting += 1
+        try:
+            await self._slots.acquire()
+        finally:
+            self._waiting -= 1
+        if self.draining:
+            self._slots.release()
+            return web.Response(status=503)
+        self.received += 1
+        task = asyncio.create_task(self._process(update))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return web.Response()
+
+    async def _process(self, update: dict) -> None:
+        try:
+            await self.process_update(update)
+        except Exception as e:
+            self.failed += 1
+            logger.error(f"Update {update.get('update_id')} failed: {e!r}")
+        finally:
+            self._slots.release()
+
+    async def drain(self) -> None:
+        """Stops accepting updates and waits for running ones and for requests waiting for a slot"""
+        self.draining = True
+        if self._tasks:
+            logger.info(f"Waiting for {len(self._tasks)} updates")
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.drain_timeout_s
+        while self._tasks or self._waiting:
+            if not self._tasks:
+                # waiting requests get freed slots and are rejected
+                await asyncio.sleep(0)
+                continue
+            _, pending = await asyncio.wait(self._tasks, timeout=max(deadline - loop.time(), 0))
+            if pending:
+                for task in pending:
+                    task.cancel()
+                logger.warning(f"Cancelled {len(pending)} updates after {self.drain_timeout_s} s")
+                await asyncio.gather(*pending, return_exceptions=True)
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "received": self.received,
+            "running": len(self._tasks),
+            "waiting": self._waiting,
+            "failed": self.failed,
+            "rejected": self.rejected,
+        }
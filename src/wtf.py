@@ -9,7 +9,7 @@ from async_model import AsyncMotyaModel, THEME_MODEL, PIC_MODEL
 
 async def recreate():
     motya = await AsyncMotyaModel.create()
-    helper_p = bot_config_db.get_helper_prompt()
+    helper_p = await bot_config_db.get_helper_prompt()
     await motya._execute(f"""
                 CREATE MODEL {THEME_MODEL}
                 PREDICT response
@@ -20,6 +20,7 @@ async def recreate():
                 prompt_template = 'From input message: {{{{text}}}}\
                 {helper_p}';""".strip()
             )
+    await motya.close()
 
 
 if __name__ == "__main__":